@@ -0,0 +1,4 @@
+"""Offline benchmarks of the XP database and the bot handlers.
+
+Run them with `python -m benchmarks`, see `python -m benchmarks --help`.
+"""
@@ -0,0 +1,101 @@
+import argparse
+import logging
+import sys
+import tempfile
+
+from . import db, load
+from .timing import compare, load_results, print_results, save_results
+
+SUITES = ["db", "load"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Offline benchmarks of XPDatabase and the bot handlers.",
+    )
+    # Checked by hand, argparse rejects an empty list against the choices
+    parser.add_argument("suites", nargs="*", metavar="{db,load}",
+                        help="suites to run, both if unset")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000",
+                        help="comma separated user counts of the db suite")
+    parser.add_argument("--iterations", type=int, default=1000,
+                        help="calls per database method")
+    parser.add_argument("--only", default="",
+                        help="comma separated database methods to run")
+    parser.add_argument("--write-behind", action="store_true",
+                        help="benchmark the write-behind database mode")
+    parser.add_argument("--pragma-profile", default="default",
+                        help="SQLite PRAGMA profile of the databases")
+    parser.add_argument("--storage", choices=["sqlite", "memory"],
+                        default="sqlite", help="storage engine to benchmark")
+    parser.add_argument("--updates", type=int, default=20000,
+                        help="updates generated by the load suite")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--users", type=int, default=200,
+                        help="members of each chat of the load suite")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rate", type=float, default=None,
+                        help="updates per second, all at once if unset")
+    parser.add_argument("--api-latency", type=float, default=0.0,
+                        help="seconds each stubbed Telegram call takes")
+    parser.add_argument("--cooldown", type=int, default=0,
+                        help="XP cooldown of the generated chats")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the outbox flood limits and the sender "
+                             "throttle in the load suite")
+    parser.add_argument("--workdir", default=None,
+                        help="where databases are created, a temporary "
+                             "directory if unset")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--baseline",
+                        help="compare against results saved with --output")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+    suites = args.suites or SUITES
+    for suite in suites:
+        if suite not in SUITES:
+            parser.error(f"argument suites: invalid choice: {suite!r} "
+                         f"(choose from 'db', 'load')")
+
+    # The bot logs at INFO level as soon as it is imported
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        results = {}
+        if "db" in suites:
+            sizes = [int(size) for size in args.sizes.split(",")]
+            only = set(filter(None, args.only.split(",")))
+            results.update(db.run(sizes, args.iterations, workdir,
+                                  write_behind=args.write_behind,
+                                  pragma_profile=args.pragma_profile,
+                                  only=only, storage=args.storage))
+        if "load" in suites:
+            db_options = {"write_behind": args.write_behind}
+            if args.storage == "sqlite":
+                db_options["pragma_profile"] = args.pragma_profile
+            results.update(load.run(
+                args.updates, workdir, chats=args.chats, users=args.users,
+                concurrency=args.concurrency, rate=args.rate,
+                latency=args.api_latency, cooldown=args.cooldown,
+                rate_limits=args.rate_limits,
+                db_options=db_options, storage=args.storage,
+            ))
+
+    baseline = load_results(args.baseline) if args.baseline else None
+    print_results(results, baseline)
+    if args.output:
+        save_results(args.output, results)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Slower than the baseline: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
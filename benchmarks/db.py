@@ -0,0 +1,171 @@
+import os
+import random
+import time
+
+from database_queries import BACKENDS, XPDatabase
+from database_queries.xp_database import day_of
+
+from .timing import time_calls
+
+# The chat holding every seeded user, other chats only exist to be toggled
+CHAT_ID = -1000
+SEED_BATCH = 50000
+
+
+def seed(db, users):
+    """Fill a database with one chat of `users` users, a previous season,
+    a day of rollups and an old XP history, in a few large transactions."""
+    conn = db.conn
+    rng = random.Random(users)
+    today = day_of(time.time())
+    old = time.time() - 400 * 24 * 3600
+
+    conn.execute("INSERT OR REPLACE INTO chat_settings VALUES (?, 1)", (CHAT_ID,))
+    conn.execute("INSERT OR REPLACE INTO chat_cooldown VALUES (?, 0)", (CHAT_ID,))
+    for season in ("previous", None):
+        for start in range(1, users + 1, SEED_BATCH):
+            ids = range(start, min(start + SEED_BATCH, users + 1))
+            conn.executemany(
+                "INSERT INTO user_xp (chat_id, user_id, xp) VALUES (?, ?, ?)",
+                ((CHAT_ID, user_id, rng.randint(-50, 500)) for user_id in ids))
+            if season is None:
+                conn.executemany(
+                    "INSERT INTO username VALUES (?, ?, ?, ?)",
+                    ((CHAT_ID, user_id, f"User {user_id}", old) for user_id in ids))
+                conn.executemany(
+                    "INSERT INTO xp_daily VALUES (?, ?, ?, ?)",
+                    ((CHAT_ID, today, user_id, rng.randint(1, 20)) for user_id in ids))
+                conn.executemany(
+                    "INSERT INTO xp_events (chat_id, sender_id, reciever_id,"
+                    " xp_delta, created_at) VALUES (?, ?, ?, 1, ?)",
+                    ((CHAT_ID, user_id + 1, user_id, old) for user_id in ids))
+        conn.commit()
+        if season is not None:
+            db.start_new_season(season)
+
+
+def seed_storage(db, users):
+    """Same data as seed() through the storage interface, for the engines
+    without SQL. The history and rollups are all from now."""
+    rng = random.Random(users)
+    db.enable_chat(CHAT_ID)
+    db.set_chat_cooldown(CHAT_ID, 0)
+    for season in ("previous", None):
+        for user_id in range(1, users + 1):
+            db.update_user_xp(CHAT_ID, user_id, rng.randint(-50, 500),
+                              sender_id=user_id + 1)
+            if season is None:
+                db.update_username(CHAT_ID, user_id, f"User {user_id}")
+        if season is not None:
+            db.start_new_season(season)
+    db.checkpoint()
+
+
+# Operations reaching into the SQLite engine's caches
+SQLITE_ONLY = {"is_chat_enabled_uncached", "get_top_users_cold"}
+
+
+def operations(db, users, rng):
+    """(name, func(i), iterations or None for the default) of every
+    XPDatabase method, the destructive ones running a fixed number of times."""
+    def user(_=None):
+        return rng.randint(1, users)
+
+    def toggle_chat(i):
+        chat_id = CHAT_ID - 1 - i % 100
+        if i % 2:
+            db.disable_chat(chat_id)
+        else:
+            db.enable_chat(chat_id)
+
+    def cold_leaderboard(_):
+        db._leaderboards.pop(CHAT_ID, None)
+        db.get_top_users(CHAT_ID)
+
+    removed = iter(range(users, 0, -1))
+    before = time.time() - 365 * 24 * 3600
+    before_day = day_of(time.time()) + 1
+
+    return [
+        ("is_chat_enabled", lambda i: db.is_chat_enabled(CHAT_ID), None),
+        ("is_chat_enabled_uncached",
+         lambda i: (db._invalidate_chat_settings(CHAT_ID),
+                    db.is_chat_enabled(CHAT_ID)), None),
+        ("get_chat_cooldown", lambda i: db.get_chat_cooldown(CHAT_ID), None),
+        ("enable_disable_chat", toggle_chat, None),
+        ("set_chat_cooldown",
+         lambda i: db.set_chat_cooldown(CHAT_ID, i % 60), None),
+        ("get_top_users_cold", cold_leaderboard, 5),
+        ("get_top_users", lambda i: db.get_top_users(CHAT_ID), None),
+        ("get_user_xp", lambda i: db.get_user_xp(CHAT_ID, user()), None),
+        ("get_medal", lambda i: db.get_medal(CHAT_ID, user()), None),
+        ("get_rank", lambda i: db.get_rank(CHAT_ID, user()), None),
+        ("update_user_xp",
+         lambda i: db.update_user_xp(CHAT_ID, user(), 1, sender_id=user()), None),
+        ("get_window_top_users_week",
+         lambda i: db.get_window_top_users(CHAT_ID, 7), 20),
+        ("get_xp_events", lambda i: db.get_xp_events(CHAT_ID, user()), None),
+        ("get_xp_events_chat", lambda i: db.get_xp_events(CHAT_ID), None),
+        ("update_username",
+         lambda i: db.update_username(CHAT_ID, user(), f"Name {i}"), None),
+        ("refresh_username",
+         lambda i: db.refresh_username(CHAT_ID, user(), f"Name {i}"), None),
+        ("get_stored_username_by_user_id",
+         lambda i: db.get_stored_username_by_user_id(CHAT_ID, user()), None),
+        ("get_stored_usernames",
+         lambda i: db.get_stored_usernames(CHAT_ID, [user() for _ in range(10)]),
+         None),
+        ("get_bot_added_by", lambda i: db.get_bot_added_by(CHAT_ID), None),
+        ("get_seasons", lambda i: db.get_seasons(), None),
+        ("get_season_top_users",
+         lambda i: db.get_season_top_users("previous", CHAT_ID), 100),
+        ("get_season_user_xp",
+         lambda i: db.get_season_user_xp("previous", CHAT_ID, user()), None),
+        ("remove_user", lambda i: db.remove_user(next(removed), CHAT_ID),
+         min(users // 10, 200)),
+        ("flush", lambda i: db.flush(), None),
+        ("checkpoint", lambda i: db.checkpoint(), 20),
+        ("optimize", lambda i: db.optimize(), 5),
+        ("incremental_vacuum", lambda i: db.incremental_vacuum(), 20),
+        ("compact_xp_events", lambda i: db.compact_xp_events(before), 10),
+        ("compact_xp_daily", lambda i: db.compact_xp_daily(before_day), 10),
+        ("start_new_season",
+         lambda i: db.start_new_season(f"bench-{i}"), 1),
+    ]
+
+
+def run(sizes, iterations, workdir, write_behind=False,
+        pragma_profile="default", only=None, storage="sqlite"):
+    """Benchmark every storage method on a fresh database of each size."""
+    results = {}
+    engine = BACKENDS[storage]
+    options = {"write_behind": write_behind}
+    if engine is XPDatabase:
+        options["pragma_profile"] = pragma_profile
+    for users in sizes:
+        path = os.path.join(workdir, f"bench_{users}{engine.extension}")
+        for suffix in ("", "-wal", "-shm", ".journal"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+        db = engine(path, **options)
+        started = time.perf_counter()
+        if engine is XPDatabase:
+            seed(db, users)
+        else:
+            seed_storage(db, users)
+        print(f"Seeded {users} users in {time.perf_counter() - started:.1f}s")
+
+        rng = random.Random(0)
+        for name, func, count in operations(db, users, rng):
+            if only and name not in only:
+                continue
+            if engine is not XPDatabase and name in SQLITE_ONLY:
+                continue
+            key = f"db/{users}/{name}"
+            try:
+                results[key] = time_calls(func, count or iterations)
+            except Exception as e:
+                results[key] = {"error": f"{type(e).__name__}: {e}"}
+        db.close()
+    return results
@@ -0,0 +1,188 @@
+import asyncio
+import itertools
+import json
+import os
+import random
+import shutil
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from telegram import Chat, ChatMemberMember, Message, Update, User
+
+from .timing import summarize
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+BOT_ID = 1
+UNLIMITED = 1e9
+
+# Share of each kind of update, most group messages are not triggers
+MIX = {"chatter": 0.6, "vote": 0.3, "xp": 0.05, "top": 0.05}
+
+
+class StubBot:
+    """Stands in for telegram.Bot, answering every call locally after an
+    optional simulated API latency."""
+
+    id = BOT_ID
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self._message_ids = itertools.count(1_000_000)
+
+    async def _call(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call()
+        return SimpleNamespace(message_id=next(self._message_ids),
+                               chat_id=chat_id, text=text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None,
+                                **kwargs):
+        await self._call()
+        return SimpleNamespace(message_id=message_id, chat_id=chat_id, text=text)
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await self._call()
+        return True
+
+    async def get_chat_member(self, chat_id, user_id, **kwargs):
+        await self._call()
+        return ChatMemberMember(user=_user(user_id))
+
+
+def _user(user_id):
+    return User(user_id, f"User {user_id}", False, username=f"user{user_id}")
+
+
+def generate_updates(count, chats, users, trigger, seed=0):
+    """Build `count` (kind, Update, args) from the MIX, spread over `chats`
+    chats of `users` members each."""
+    rng = random.Random(seed)
+    kinds, weights = zip(*MIX.items())
+    date = datetime.now(timezone.utc)
+    message_ids = itertools.count(1)
+    updates = []
+    for update_id in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        chat = Chat(-100 - rng.randrange(chats), Chat.SUPERGROUP)
+        sender = _user(BOT_ID + 1 + rng.randrange(users))
+        reply_to = None
+        args = []
+        if kind == "chatter":
+            text = "hello everyone, how is it going today?"
+        elif kind == "vote":
+            text = trigger
+            reciever = _user(BOT_ID + 1 + rng.randrange(users))
+            reply_to = Message(next(message_ids), date, chat,
+                               from_user=reciever, text="nice")
+        elif kind == "xp":
+            text = "/xp"
+        else:
+            text = "/top"
+        message = Message(next(message_ids), date, chat, from_user=sender,
+                          text=text, reply_to_message=reply_to)
+        updates.append((kind, Update(update_id, message=message), args))
+    return updates
+
+
+def _workdir(workdir):
+    # The bot reads its templates and triggers from the working directory
+    for name in ("message_templates.json", "plus_minus.json"):
+        shutil.copy(os.path.join(DATA_DIR, name), workdir)
+    for name in os.listdir(workdir):
+        if name.startswith(("xp_data", "cooldowns", "last_messages")):
+            os.remove(os.path.join(workdir, name))
+    os.chdir(workdir)
+
+
+async def _run(count, chats, users, concurrency, rate, latency, cooldown,
+               rate_limits, db_options, storage):
+    from bot.outbox import Outbox
+    from bot.throttle import DEFAULT_LIMIT
+    from bot.xp_bot import XP_Bot
+
+    # Without the limits the votes of a repeat sender would mostly be
+    # dropped by the throttle and never reach the database
+    sender_rate_limit = DEFAULT_LIMIT if rate_limits else (UNLIMITED, 1)
+    xp_bot = XP_Bot("1:benchmark", False, db_options=db_options,
+                    storage=storage,
+                    concurrent_updates=concurrency,
+                    sender_rate_limit=sender_rate_limit)
+    bot = StubBot(latency)
+    if not rate_limits:
+        xp_bot.outbox = Outbox(global_rate=UNLIMITED, chat_rate=UNLIMITED,
+                               chat_burst=UNLIMITED)
+    await xp_bot.post_init(SimpleNamespace(bot=bot))
+
+    for chat_id in range(-100, -100 - chats, -1):
+        await xp_bot.db.enable_chat(chat_id)
+        await xp_bot.db.set_chat_cooldown(chat_id, cooldown)
+
+    with open("./plus_minus.json", "r") as file:
+        trigger = json.load(file)["simple_plus"][0]
+    updates = generate_updates(count, chats, users, trigger)
+    handlers = {
+        "chatter": xp_bot.change_xp,
+        "vote": xp_bot.change_xp,
+        "xp": xp_bot.check_xp,
+        "top": xp_bot.top_users,
+    }
+    handler_latencies = {kind: [] for kind in MIX}
+    total_latencies = []
+    processor = xp_bot.app.update_processor
+    clock = time.perf_counter
+
+    async def handle(kind, update, args, queued_at):
+        started = clock()
+        context = SimpleNamespace(bot=bot, args=args)
+        await handlers[kind](update, context)
+        done = clock()
+        handler_latencies[kind].append(done - started)
+        total_latencies.append(done - queued_at)
+
+    start = clock()
+    tasks = []
+    for i, (kind, update, args) in enumerate(updates):
+        # Without a rate every update arrives at once, as a burst
+        if rate:
+            delay = start + i / rate - clock()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        # Like the application, one task per update and the processor
+        # bounds the concurrency and keeps each chat in order
+        tasks.append(asyncio.create_task(processor.process_update(
+            update, handle(kind, update, args, clock()))))
+    await asyncio.gather(*tasks)
+    elapsed = clock() - start
+
+    await xp_bot.shutdown(xp_bot.app)
+
+    results = {"load/updates": summarize(total_latencies, elapsed)}
+    for kind, latencies in handler_latencies.items():
+        results[f"load/{kind}"] = summarize(latencies, elapsed)
+    results["load/updates"]["api_calls"] = bot.calls
+    # Verdicts of the votes, to tell how many got past the throttle
+    throttle = xp_bot.throttle.stats()
+    for verdict in ("allowed", "notified", "dropped"):
+        results["load/vote"][f"throttle_{verdict}"] = throttle[verdict]
+    return results
+
+
+def run(count, workdir, chats=50, users=200, concurrency=32, rate=None,
+        latency=0.0, cooldown=0, rate_limits=False, db_options=None,
+        storage="sqlite"):
+    """Drive the handlers with generated updates against a stub bot and
+    return the end-to-end and per-handler results."""
+    previous = os.getcwd()
+    _workdir(workdir)
+    try:
+        return asyncio.run(_run(count, chats, users, concurrency, rate,
+                                latency, cooldown, rate_limits,
+                                db_options or {}, storage))
+    finally:
+        os.chdir(previous)
@@ -0,0 +1,79 @@
+import json
+import time
+
+# p99 changes smaller than this are timer noise on sub-millisecond calls
+NOISE_MS = 0.05
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(fraction * len(values)) - 1))
+    return values[index]
+
+
+def summarize(latencies, elapsed):
+    """Throughput and latency percentiles of a run, latencies in seconds."""
+    latencies = sorted(latencies)
+    return {
+        "samples": len(latencies),
+        "ops_per_sec": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def time_calls(func, iterations):
+    """Call func(i) `iterations` times and summarize the latencies."""
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for i in range(iterations):
+        before = clock()
+        func(i)
+        latencies.append(clock() - before)
+    return summarize(latencies, clock() - start)
+
+
+def print_results(results, baseline=None):
+    """Print one line per benchmark, with the change against the baseline."""
+    baseline = baseline or {}
+    width = max((len(name) for name in results), default=0)
+    print(f"{'benchmark':<{width}}  {'ops/s':>11}  {'p50 ms':>9}  {'p99 ms':>9}")
+    for name, result in results.items():
+        if "error" in result:
+            print(f"{name:<{width}}  error: {result['error']}")
+            continue
+        line = (f"{name:<{width}}  {result['ops_per_sec']:>11.1f}"
+                f"  {result['p50_ms']:>9.3f}  {result['p99_ms']:>9.3f}")
+        old = baseline.get(name)
+        if old and "error" not in old and old["p99_ms"] > 0:
+            change = (result["p99_ms"] - old["p99_ms"]) / old["p99_ms"]
+            line += f"  p99 {change:+.0%}"
+        print(line)
+
+
+def compare(results, baseline, tolerance):
+    """Return the benchmarks whose throughput dropped or p99 grew by more
+    than `tolerance` (a fraction) compared to the baseline."""
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old or "error" in old or "error" in result:
+            continue
+        slower = result["p99_ms"] > max(old["p99_ms"] * (1 + tolerance),
+                                        old["p99_ms"] + NOISE_MS)
+        if slower or result["ops_per_sec"] < old["ops_per_sec"] * (1 - tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def load_results(path):
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def save_results(path, results):
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2, sort_keys=True)
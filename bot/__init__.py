@@ -3,6 +3,7 @@ from dotenv import load_dotenv
 import os
 
 from .xp_bot import XP_Bot
+from .sharding import ShardCoordinator
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -15,5 +16,87 @@ def start():
     ERASE_NEW_YEAR = os.environ.get("ERASE_NEW_YEAR")
     ERASE_NEW_YEAR = True if ERASE_NEW_YEAR == "true" else False
 
-    xp_bot = XP_Bot(TOKEN, ERASE_NEW_YEAR)
+    # SQLite, or "memory" to keep everything in memory with snapshots
+    STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite")
+    STORAGE_PATH = os.environ.get("STORAGE_PATH") or None
+
+    # Write-behind mode batches XP changes into one commit per window
+    db_options = {
+        "write_behind": os.environ.get("DB_WRITE_BEHIND") == "true",
+        "flush_interval": float(os.environ.get("DB_FLUSH_INTERVAL", 1.0)),
+        "flush_batch": int(os.environ.get("DB_FLUSH_BATCH", 500)),
+    }
+    if STORAGE_BACKEND == "sqlite":
+        db_options["pragma_profile"] = os.environ.get(
+            "DB_PRAGMA_PROFILE", "default")
+
+    # Seconds a chat member status is reused before asking Telegram again
+    MEMBER_CACHE_TTL = float(os.environ.get("MEMBER_CACHE_TTL", 60))
+
+    # Receive updates through a webhook instead of polling when configured
+    WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+    webhook = None
+    if WEBHOOK_URL:
+        webhook = {
+            "listen": os.environ.get("WEBHOOK_LISTEN", "0.0.0.0"),
+            "port": int(os.environ.get("WEBHOOK_PORT", 8443)),
+            "url_path": os.environ.get("WEBHOOK_PATH", ""),
+            "webhook_url": WEBHOOK_URL,
+            "secret_token": os.environ.get("WEBHOOK_SECRET"),
+        }
+
+    # Updates of different chats are handled in parallel, up to this many
+    CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 32))
+
+    # XP changes each sender can make in a burst, and the seconds it takes
+    # to be available again, chats can set their own with /setlimit
+    changes, seconds = os.environ.get("SENDER_RATE_LIMIT", "5/60").split("/")
+    SENDER_RATE_LIMIT = (int(changes), int(seconds))
+
+    # "edit" merges the XP notifications of a chat into one status message
+    # edited in place, at most once every NOTIFY_DEBOUNCE seconds
+    NOTIFY_MODE = os.environ.get("NOTIFY_MODE", "reply")
+    NOTIFY_DEBOUNCE = float(os.environ.get("NOTIFY_DEBOUNCE", 2.0))
+
+    # Days of XP change history kept in the xp_events ledger
+    EVENT_RETENTION_DAYS = float(os.environ.get("EVENT_RETENTION_DAYS", 365))
+
+    # Serve Prometheus metrics locally when a port is configured
+    METRICS_PORT = os.environ.get("METRICS_PORT")
+    metrics_address = None
+    if METRICS_PORT:
+        metrics_address = (
+            os.environ.get("METRICS_LISTEN", "127.0.0.1"), int(METRICS_PORT))
+    # Or write them to a file for the node exporter textfile collector
+    METRICS_FILE = os.environ.get("METRICS_FILE") or None
+
+    # Split the chats between this many worker processes
+    SHARDS = int(os.environ.get("SHARDS", 1))
+
+    if SHARDS > 1:
+        bot_options = {
+            "db_options": db_options,
+            "member_cache_ttl": MEMBER_CACHE_TTL,
+            "concurrent_updates": CONCURRENT_UPDATES,
+            "event_retention_days": EVENT_RETENTION_DAYS,
+            "metrics_address": metrics_address,
+            "metrics_file": METRICS_FILE,
+            "storage": STORAGE_BACKEND,
+            "db_path": STORAGE_PATH,
+            "sender_rate_limit": SENDER_RATE_LIMIT,
+            "notify_mode": NOTIFY_MODE,
+            "notify_debounce": NOTIFY_DEBOUNCE,
+        }
+        coordinator = ShardCoordinator(
+            TOKEN, ERASE_NEW_YEAR, SHARDS, bot_options, webhook)
+        coordinator.run()
+        return
+
+    xp_bot = XP_Bot(TOKEN, ERASE_NEW_YEAR, db_options, MEMBER_CACHE_TTL,
+                    webhook, CONCURRENT_UPDATES,
+                    event_retention_days=EVENT_RETENTION_DAYS,
+                    metrics_address=metrics_address,
+                    metrics_file=METRICS_FILE, storage=STORAGE_BACKEND,
+                    db_path=STORAGE_PATH, sender_rate_limit=SENDER_RATE_LIMIT,
+                    notify_mode=NOTIFY_MODE, notify_debounce=NOTIFY_DEBOUNCE)
     xp_bot.run()
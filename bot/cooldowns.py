@@ -0,0 +1,74 @@
+import heapq
+import time
+
+
+class CooldownTracker:
+    """Time of the last XP change per (chat, sender, reciever).
+
+    Entries are dropped from a min-heap as soon as the chat cooldown they
+    were recorded with has passed, the oldest ones are evicted once
+    `max_entries` is reached, and the whole state can be snapshotted.
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        # key -> (changed_at, expires_at), wall clock so it survives restarts
+        self._entries = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def remaining(self, chat_id, sender_id, reciever_id, cooldown):
+        """Seconds before sender can change reciever's XP again, 0 if allowed."""
+        now = time.time()
+        self._expire(now)
+        entry = self._entries.get((chat_id, sender_id, reciever_id))
+        if entry is None:
+            return 0
+        return max(0, entry[0] + cooldown - now)
+
+    def touch(self, chat_id, sender_id, reciever_id, cooldown):
+        """Record an XP change happening now."""
+        now = time.time()
+        self._set((chat_id, sender_id, reciever_id), now, now + cooldown)
+        self._expire(now)
+        while len(self._entries) > self.max_entries:
+            self._pop()
+
+    def _set(self, key, changed_at, expires_at):
+        self._entries[key] = (changed_at, expires_at)
+        heapq.heappush(self._heap, (expires_at, key))
+        # Touching a key again leaves its old heap item behind
+        if len(self._heap) > 2 * len(self._entries) + 1024:
+            self._heap = [(e[1], k) for k, e in self._entries.items()]
+            heapq.heapify(self._heap)
+
+    def _pop(self):
+        expires_at, key = heapq.heappop(self._heap)
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] == expires_at:
+            del self._entries[key]
+
+    def _expire(self, now):
+        while self._heap and self._heap[0][0] <= now:
+            self._pop()
+
+    def trim(self):
+        """Forget every entry whose cooldown has passed."""
+        self._expire(time.time())
+
+    def dump(self):
+        """Return the live entries as a JSON-serializable list."""
+        self._expire(time.time())
+        return [[*key, *entry] for key, entry in self._entries.items()]
+
+    def load(self, rows):
+        """Restore entries from dump(), skipping the ones that expired since."""
+        now = time.time()
+        for chat_id, sender_id, reciever_id, changed_at, expires_at in rows:
+            if expires_at > now:
+                self._set((chat_id, sender_id, reciever_id),
+                          changed_at, expires_at)
+        while len(self._entries) > self.max_entries:
+            self._pop()
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from pytz import timezone
+
+logger = logging.getLogger(__name__)
+
+NEW_YEAR_TIMEZONE = timezone("Europe/Paris")
+
+# Longest single sleep of a job waiting for a date, so that it notices
+# the clock being changed or the host waking up from a suspend
+MAX_SLEEP = 3600
+
+
+def next_new_year(now):
+    """Midnight of the next January 1st in Paris, after the aware `now`."""
+    year = now.astimezone(NEW_YEAR_TIMEZONE).year + 1
+    return NEW_YEAR_TIMEZONE.localize(datetime(year, 1, 1))
+
+
+class _Job:
+    def __init__(self, name, wait, func, budget):
+        self.name = name
+        self.wait = wait
+        self.func = func
+        self.budget = budget
+        self.task = None
+
+
+class Scheduler:
+    """Runs jobs as tasks of the running event loop, without a thread.
+
+    A job is a coroutine function called with the monotonic deadline of its
+    time budget, or None without one. Long jobs work in small steps and
+    stop once the deadline is reached, to carry on at their next run.
+    Runs of a job never overlap and a failed run is only logged.
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self._jobs = {}
+        self._running = False
+
+    def every(self, name, interval, func, budget=None):
+        """Run `func` every `interval` seconds, counted from the end of a run."""
+        async def wait():
+            await asyncio.sleep(interval)
+        self._add(_Job(name, wait, func, budget))
+
+    def at(self, name, next_time, func, budget=None):
+        """Run `func` at each date `next_time(now)` returns for an aware `now`."""
+        async def wait():
+            target = next_time(datetime.now(NEW_YEAR_TIMEZONE))
+            while (left := (target - datetime.now(NEW_YEAR_TIMEZONE))
+                   .total_seconds()) > 0:
+                await asyncio.sleep(min(left, MAX_SLEEP))
+        self._add(_Job(name, wait, func, budget))
+
+    def _add(self, job):
+        if job.name in self._jobs:
+            raise ValueError(f"Job {job.name} is already scheduled")
+        self._jobs[job.name] = job
+        if self._running:
+            job.task = asyncio.create_task(self._loop(job))
+
+    def start(self):
+        self._running = True
+        for job in self._jobs.values():
+            job.task = asyncio.create_task(self._loop(job))
+
+    async def stop(self):
+        """Cancel every job, including the runs in progress."""
+        self._running = False
+        tasks = [job.task for job in self._jobs.values() if job.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for job in self._jobs.values():
+            job.task = None
+
+    async def run(self, name):
+        """Run a job once, right away."""
+        await self._run(self._jobs[name])
+
+    async def _loop(self, job):
+        while True:
+            await job.wait()
+            await self._run(job)
+
+    async def _run(self, job):
+        started = time.monotonic()
+        deadline = None if job.budget is None else started + job.budget
+        try:
+            await job.func(deadline)
+        except Exception as e:
+            logger.error(f"Job {job.name} failed: {e}")
+            if self.metrics is not None:
+                self.metrics.inc("xp_bot_job_errors_total", job=job.name)
+        elapsed = time.monotonic() - started
+        if self.metrics is not None:
+            self.metrics.observe("xp_bot_job_seconds", elapsed, job=job.name)
+        # The step started right before the deadline may overrun it a bit
+        if job.budget is not None and elapsed > 2 * job.budget:
+            logger.warning(
+                f"Job {job.name} took {elapsed:.2f}s, over its "
+                f"{job.budget}s budget")
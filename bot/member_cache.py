@@ -0,0 +1,92 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class MemberCache:
+    """TTL cache of get_chat_member results keyed by (chat_id, user_id).
+
+    Concurrent lookups of a member that isn't cached share a single API
+    call, and the cache keeps at most `max_entries` members.
+    """
+
+    def __init__(self, ttl=60, max_entries=20000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (member, expires_at), least recently used first
+        self._entries = OrderedDict()
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, bot, chat_id, user_id, fresh=False):
+        """Return the ChatMember of a user, calling Telegram only if needed.
+
+        With `fresh` the member is always fetched again, for the permission
+        checks a demotion must apply to right away.
+        """
+        key = (chat_id, user_id)
+        if fresh:
+            self.invalidate(chat_id, user_id)
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+        task = self._pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(bot, key))
+            self._pending[key] = task
+        else:
+            self.coalesced += 1
+        # Shielded so a cancelled handler doesn't cancel the shared lookup
+        return await asyncio.shield(task)
+
+    async def _fetch(self, bot, key):
+        try:
+            member = await bot.get_chat_member(*key)
+        finally:
+            current = self._pending.get(key) is asyncio.current_task()
+            if current:
+                del self._pending[key]
+
+        # Don't cache a lookup that was invalidated while in flight
+        if current:
+            self._entries.pop(key, None)
+            self._entries[key] = (member, time.monotonic() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return member
+
+    def invalidate(self, chat_id, user_id=None):
+        """Forget a member, or every member of the chat if user_id is None."""
+        if user_id is not None:
+            keys = [(chat_id, user_id)]
+        else:
+            keys = [key for key in [*self._entries, *self._pending]
+                    if key[0] == chat_id]
+        for key in keys:
+            self._entries.pop(key, None)
+            self._pending.pop(key, None)
+
+    def trim(self):
+        """Forget every expired member."""
+        now = time.monotonic()
+        for key in [key for key, entry in self._entries.items() if entry[1] <= now]:
+            del self._entries[key]
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
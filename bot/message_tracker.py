@@ -0,0 +1,60 @@
+import time
+from collections import OrderedDict
+
+# Telegram doesn't let bots delete messages older than 48 hours
+DELETABLE_FOR = 48 * 3600
+
+
+class MessageTracker:
+    """Id of the last message sent by the bot per slot, like ("top", chat_id).
+
+    Slots are kept in least recently updated order, capped at `max_entries`,
+    and forgotten once their message is older than `ttl` seconds.
+    """
+
+    def __init__(self, max_entries=50000, ttl=DELETABLE_FOR):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (message_id, sent_at), oldest first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the tracked message id of a slot, None if unknown or expired."""
+        entry = self._entries.get(key)
+        if entry is None or time.time() - entry[1] >= self.ttl:
+            return None
+        return entry[0]
+
+    def replace(self, key, message_id):
+        """Track a new message and return the previous one of the slot, if any."""
+        previous = self.get(key)
+        self._entries.pop(key, None)
+        self._entries[key] = (message_id, time.time())
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return previous
+
+    def trim(self):
+        """Forget every expired slot."""
+        deadline = time.time() - self.ttl
+        while self._entries:
+            key, (_, sent_at) = next(iter(self._entries.items()))
+            if sent_at > deadline:
+                break
+            del self._entries[key]
+
+    def dump(self):
+        """Return the live slots as a JSON-serializable list."""
+        self.trim()
+        return [[list(key), *entry] for key, entry in self._entries.items()]
+
+    def load(self, rows):
+        """Restore slots from dump()."""
+        for key, message_id, sent_at in sorted(rows, key=lambda row: row[2]):
+            self._entries[tuple(key)] = (message_id, sent_at)
+        self.trim()
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import threading
+import time
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Histogram buckets in seconds, from a cached lookup to a slow API call
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+class Metrics:
+    """Counters, histograms and gauges rendered in the Prometheus text format.
+
+    Counters and histograms can be updated from any thread. Gauges are
+    callbacks read at scrape time, returning a number or a list of
+    (labels dict, number).
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # name -> (type, help)
+        self._meta = {}
+        # (name, sorted label items) -> value or [bucket counts, sum, count]
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._meta.setdefault(name, ("counter", ""))
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                self._meta.setdefault(name, ("histogram", ""))
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def gauge(self, name, help_text, func, kind="gauge"):
+        """Register a value read when scraped, `kind` is "counter" for
+        totals kept by another object."""
+        self.describe(name, kind, help_text)
+        self._gauges[name] = func
+
+    def get(self, name, **labels):
+        """Current value of a counter, or (count, sum) of a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._histograms:
+                _, total, count = self._histograms[key]
+                return count, total
+            return self._counters.get(key, 0)
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h[0]), h[1], h[2])
+                          for key, h in self._histograms.items()}
+
+        samples = {}
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append(f"{name}{_labels(labels)} {value}")
+
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                le = _labels([*labels, ("le", bound)])
+                lines.append(f"{name}_bucket{le} {cumulative}")
+            lines.append(f"{name}_bucket{_labels([*labels, ('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+
+        for name, func in self._gauges.items():
+            try:
+                value = func()
+            except Exception as e:
+                logger.warning(f"Could not read metric {name}: {e}")
+                continue
+            if not isinstance(value, list):
+                value = [({}, value)]
+            samples[name] = [
+                f"{name}{_labels(sorted(labels.items()))} {number}"
+                for labels, number in value
+            ]
+
+        output = []
+        for name, lines in sorted(samples.items()):
+            kind, help_text = self._meta[name]
+            if help_text:
+                output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(lines)
+        return "\n".join(output) + "\n"
+
+
+class MetricsServer:
+    """Minimal HTTP server answering GET /metrics, meant for a local scraper."""
+
+    def __init__(self, metrics, host="127.0.0.1", port=9090):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port)
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # Only the request line matters, skip the headers
+            while await asyncio.wait_for(reader.readline(), 5) not in (
+                    b"\r\n", b"\n", b""):
+                pass
+            parts = request.decode("latin-1").split()
+            path = parts[1].split("?")[0] if len(parts) >= 2 else None
+            if parts and parts[0] == "GET" and path == "/metrics":
+                status = "200 OK"
+                body = self.metrics.render().encode()
+            else:
+                status = "404 Not Found"
+                body = b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest recording the latency and errors of each Bot API method."""
+
+    def __init__(self, metrics, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = metrics
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(
+                url, method, request_data, **kwargs)
+        except Exception as e:
+            self.metrics.inc("xp_bot_telegram_errors_total",
+                             method=endpoint, error=type(e).__name__)
+            raise
+        finally:
+            self.metrics.observe("xp_bot_telegram_request_seconds",
+                                 time.perf_counter() - start, method=endpoint)
+        if code >= 400:
+            self.metrics.inc("xp_bot_telegram_errors_total",
+                             method=endpoint, error=str(code))
+        return code, payload
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+from telegram.error import BadRequest, TelegramError
+
+from .outbox import REPLY
+
+logger = logging.getLogger(__name__)
+
+# Seconds XP notifications of a chat are collected before going out
+DEBOUNCE = 2.0
+# Lines of a summary, the older ones are only counted
+MAX_LINES = 10
+
+
+class XPNotifier:
+    """Merges the XP notifications of each chat into one status message.
+
+    Lines added to a chat within `debounce` seconds are sent together,
+    a later line with the same key replacing the earlier one. The status
+    message tracked in `last_messages` under ("xp_update", chat_id) is
+    edited in place, and only when it can't be a new one is sent. A chat
+    gets at most one send or edit per window whatever the number of lines.
+    """
+
+    def __init__(self, outbox, last_messages, debounce=DEBOUNCE,
+                 max_lines=MAX_LINES, more="... and {count} more"):
+        self.outbox = outbox
+        self.last_messages = last_messages
+        self.debounce = debounce
+        self.max_lines = max_lines
+        self.more = more
+        # chat_id -> OrderedDict(key -> line) waiting for the next summary
+        self._lines = {}
+        # chat_id -> task sending the summaries of the chat
+        self._tasks = {}
+        self.added = 0
+        self.edited = 0
+        self.sent = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._lines)
+
+    def add(self, chat_id, key, line):
+        """Queue a line for the next summary of the chat."""
+        lines = self._lines.setdefault(chat_id, OrderedDict())
+        lines.pop(key, None)
+        lines[key] = line
+        self.added += 1
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.create_task(self._run(chat_id))
+
+    async def stop(self):
+        """Send what is still waiting right away."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for chat_id in list(self._lines):
+            await self._flush(chat_id)
+
+    async def _run(self, chat_id):
+        try:
+            # Lines added while a summary goes out wait for the next window
+            while chat_id in self._lines:
+                await asyncio.sleep(self.debounce)
+                await self._flush(chat_id)
+        finally:
+            self._tasks.pop(chat_id, None)
+
+    def summary(self, lines):
+        lines = list(lines.values())
+        text = "\n".join(lines[-self.max_lines:])
+        if len(lines) > self.max_lines:
+            text += "\n" + self.more.format(count=len(lines) - self.max_lines)
+        return text
+
+    async def _flush(self, chat_id):
+        lines = self._lines.pop(chat_id, None)
+        if not lines:
+            return
+        text = self.summary(lines)
+        key = ("xp_update", chat_id)
+        try:
+            message_id = self.last_messages.get(key)
+            if message_id is not None and await self._edit(
+                    chat_id, message_id, text):
+                self.edited += 1
+                return
+            message = await self.outbox.call(
+                "send_message", chat_id, REPLY, text=text)
+            self.sent += 1
+            previous = self.last_messages.replace(key, message.message_id)
+            if previous is not None:
+                self.outbox.delete_message(chat_id, previous)
+        except TelegramError as e:
+            self.failed += 1
+            logger.info(f"XP notification in {chat_id} failed: {e}")
+
+    async def _edit(self, chat_id, message_id, text):
+        """Edit the status message, False if it can't be edited anymore."""
+        try:
+            await self.outbox.call("edit_message_text", chat_id, REPLY,
+                                   message_id=message_id, text=text)
+        except BadRequest as e:
+            # Same text as before, the message is already up to date
+            if "not modified" in str(e):
+                return True
+            return False
+        return True
+
+    def stats(self):
+        return {
+            "pending": len(self._lines),
+            "added": self.added,
+            "edited": self.edited,
+            "sent": self.sent,
+            "failed": self.failed,
+        }
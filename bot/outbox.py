@@ -0,0 +1,334 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict, deque
+from datetime import timedelta
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Job priorities, lower goes first
+REPLY = 0
+DELETE = 1
+BROADCAST = 2
+
+# Telegram allows about 30 messages per second overall and 20 per minute
+# in a given group
+GLOBAL_RATE = 30
+CHAT_RATE = 20 / 60
+CHAT_BURST = 5
+
+
+class TokenBucket:
+    """Allows `rate` operations per second with bursts of `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds before a token is available, 0 if one is available now."""
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ("method", "chat_id", "kwargs", "priority", "future",
+                 "on_done", "attempts", "queued_at", "seq")
+
+    def __init__(self, method, chat_id, kwargs, priority, future, on_done=None):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = future
+        self.on_done = on_done
+        self.attempts = 0
+        self.queued_at = time.monotonic()
+        self.seq = None
+
+
+class Outbox:
+    """Single queue for every message the bot sends or deletes.
+
+    Jobs are dispatched by priority under a global token bucket and one
+    bucket per chat, so replies go before deletions and a busy group can't
+    hit Telegram's flood limits. Replies and deletions are fire-and-forget,
+    so handlers never wait for a busy chat, and deletions are retried in
+    the background. A chat has at most one message in flight at a time,
+    so its messages arrive, and their callbacks run, in the queued order.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE,
+                 chat_burst=CHAT_BURST, max_pending=10000, max_retries=3,
+                 concurrency=8, max_chats=10000):
+        self.global_bucket = TokenBucket(global_rate, max(1, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.concurrency = concurrency
+        self.max_chats = max_chats
+        self.bot = None
+        self._chat_buckets = OrderedDict()
+        self._queue = None
+        self._slots = None
+        self._worker = None
+        self._counter = itertools.count()
+        self._pending = {}
+        self._tasks = set()
+        # chat_id -> jobs waiting for the message in flight in that chat
+        self._in_flight = {}
+        # job -> timer putting it back in the queue
+        self._deferred = {}
+
+        # Backpressure metrics
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.last_delay = 0.0
+
+    def start(self, bot):
+        self.bot = bot
+        self._queue = asyncio.PriorityQueue()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=5):
+        """Give queued jobs `timeout` seconds to go out, then stop."""
+        if self._worker is None:
+            return
+        deadline = time.monotonic() + timeout
+        while sum(self._pending.values()) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self._worker.cancel()
+        self._worker = None
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Don't leave the callers of `call` waiting for jobs that won't run
+        jobs = [job for parked in self._in_flight.values() for job in parked]
+        self._in_flight.clear()
+        for job, timer in self._deferred.items():
+            timer.cancel()
+            jobs.append(job)
+        self._deferred.clear()
+        while not self._queue.empty():
+            jobs.append(self._queue.get_nowait()[2])
+        for job in jobs:
+            self._cancel(job)
+
+    def depth(self, priority=None):
+        """Number of jobs waiting, for one priority or overall."""
+        if priority is not None:
+            return self._pending.get(priority, 0)
+        return sum(self._pending.values())
+
+    def send_message(self, chat_id, on_sent=None, **kwargs):
+        """Queue a message without waiting for it, `on_sent` is called with
+        the message once it is sent."""
+        self.submit("send_message", chat_id, REPLY, on_done=on_sent, **kwargs)
+
+    def delete_message(self, chat_id, message_id):
+        """Queue a message deletion without waiting for it."""
+        self.submit("delete_message", chat_id, DELETE, message_id=message_id)
+
+    async def call(self, method, chat_id, priority, **kwargs):
+        """Queue a Bot method call and wait for its result."""
+        future = asyncio.get_running_loop().create_future()
+        self._put(_Job(method, chat_id, kwargs, priority, future))
+        return await future
+
+    def submit(self, method, chat_id, priority, on_done=None, **kwargs):
+        """Queue a Bot method call without waiting for it, `on_done` is
+        called with its result if it succeeds."""
+        if self.depth() >= self.max_pending:
+            self.dropped += 1
+            logger.warning(f"Outbox full, dropping {method} in {chat_id}")
+            return
+        self._put(_Job(method, chat_id, kwargs, priority, None, on_done))
+
+    def _put(self, job):
+        self._pending[job.priority] = self._pending.get(job.priority, 0) + 1
+        self.max_depth = max(self.max_depth, self.depth())
+        job.seq = next(self._counter)
+        self._requeue(job)
+
+    def _defer(self, delay, job):
+        self._deferred[job] = asyncio.get_running_loop().call_later(
+            delay, self._requeue, job)
+
+    def _requeue(self, job):
+        self._deferred.pop(job, None)
+        if self._worker is None:
+            # Retried or deferred past `stop`
+            self._cancel(job)
+            return
+        # Retried and deferred jobs keep their place among equal priorities
+        self._queue.put_nowait((job.priority, job.seq, job))
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.pop(chat_id, None)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        self._chat_buckets[chat_id] = bucket
+        # Forget idle chats, their bucket would be full again anyway
+        while len(self._chat_buckets) > self.max_chats:
+            _, oldest = next(iter(self._chat_buckets.items()))
+            if not oldest.is_full():
+                break
+            self._chat_buckets.popitem(last=False)
+        return bucket
+
+    async def _run(self):
+        while True:
+            _, _, job = await self._queue.get()
+
+            # Deletions don't count towards the per-chat sending limit
+            chat_bucket = None
+            if job.method != "delete_message":
+                parked = self._in_flight.get(job.chat_id)
+                if parked is not None:
+                    # Wait for the previous message of the chat to be sent
+                    parked.append(job)
+                    continue
+                chat_bucket = self._chat_bucket(job.chat_id)
+                wait = chat_bucket.wait_time()
+                if wait > 0:
+                    # Don't hold other chats back while this one cools down
+                    self._defer(wait, job)
+                    continue
+
+            try:
+                while (wait := self.global_bucket.wait_time()) > 0:
+                    await asyncio.sleep(wait)
+                self.global_bucket.take()
+                if chat_bucket is not None:
+                    chat_bucket.take()
+                await self._slots.acquire()
+            except asyncio.CancelledError:
+                self._cancel(job)
+                raise
+
+            if chat_bucket is not None:
+                self._in_flight[job.chat_id] = deque()
+            task = asyncio.create_task(self._execute(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, job):
+        try:
+            job.attempts += 1
+            result = await getattr(self.bot, job.method)(
+                chat_id=job.chat_id, **job.kwargs)
+        except RetryAfter as e:
+            delay = e.retry_after
+            if isinstance(delay, timedelta):
+                delay = delay.total_seconds()
+            self._retry(job, delay, e)
+        except BadRequest as e:
+            # Like deleting a message that is already gone, retrying won't help
+            self._fail(job, e)
+        except NetworkError as e:
+            # A timed out send may have gone through, only retry deletions
+            if job.method == "delete_message":
+                self._retry(job, 2 ** job.attempts, e)
+            else:
+                self._fail(job, e)
+        except asyncio.CancelledError:
+            self._cancel(job)
+            raise
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            self.sent += 1
+            self._done(job)
+            if job.future is not None and not job.future.done():
+                job.future.set_result(result)
+            if job.on_done is not None:
+                try:
+                    job.on_done(result)
+                except Exception as e:
+                    logger.error(f"Callback of {job.method} in {job.chat_id} failed: {e}")
+        finally:
+            self._slots.release()
+
+    def _next_in_chat(self, chat_id):
+        # The parked jobs go back to the queue in their original order, the
+        # first one dispatched parks the others again
+        for job in self._in_flight.pop(chat_id, ()):
+            self._requeue(job)
+
+    def _retry(self, job, delay, error):
+        if job.attempts > self.max_retries:
+            self._fail(job, error)
+            return
+        self.retried += 1
+        parked = None
+        if job.method != "delete_message":
+            parked = self._in_flight.get(job.chat_id)
+        if parked is not None:
+            # The later messages of the chat keep waiting behind this one
+            parked.appendleft(job)
+            asyncio.get_running_loop().call_later(
+                delay, self._next_in_chat, job.chat_id)
+        else:
+            self._defer(delay, job)
+
+    def _fail(self, job, error):
+        self.failed += 1
+        self._done(job)
+        if job.future is not None:
+            if not job.future.done():
+                job.future.set_exception(error)
+        else:
+            logger.info(f"{job.method} in {job.chat_id} failed: {error}")
+
+    def _cancel(self, job):
+        self._done(job)
+        if job.future is not None:
+            job.future.cancel()
+
+    def _done(self, job):
+        self._pending[job.priority] -= 1
+        self.last_delay = time.monotonic() - job.queued_at
+        if job.method != "delete_message":
+            self._next_in_chat(job.chat_id)
+
+    def stats(self):
+        return {
+            "pending": self.depth(),
+            "pending_replies": self.depth(REPLY),
+            "pending_deletions": self.depth(DELETE),
+            "pending_broadcasts": self.depth(BROADCAST),
+            "max_pending": self.max_depth,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "last_delay": self.last_delay,
+        }
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+import time
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder, ContextTypes, TypeHandler
+
+from .jobs import Scheduler, next_new_year
+from .outbox import GLOBAL_RATE
+from .xp_bot import XP_Bot
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two checks that every worker is still running
+WATCH_INTERVAL = 5
+# A worker dying this many times in a row within CRASH_WINDOW seconds of
+# its start is crash looping, and stops the whole bot
+MAX_CRASHES = 5
+CRASH_WINDOW = 60
+
+
+def shard_for(update: Update, shards):
+    """Pick the shard owning an update, every update of a chat goes to the same one."""
+    if update.effective_chat is not None:
+        return update.effective_chat.id % shards
+    if update.effective_user is not None:
+        return update.effective_user.id % shards
+    return 0
+
+
+def run_shard(shard, shards, queue, TOKEN, ERASE_NEW_YEAR, bot_options):
+    """Entry point of a worker process, owning its own database and state."""
+    # The front process decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Each worker serves its own metrics, on the port following the previous one
+    address = bot_options.get("metrics_address")
+    if address is not None:
+        bot_options = {**bot_options,
+                       "metrics_address": (address[0], address[1] + shard)}
+    # Every worker sends with the same token, so they share Telegram's
+    # global limit
+    xp_bot = XP_Bot(TOKEN, ERASE_NEW_YEAR, shard=shard,
+                    global_rate=GLOBAL_RATE / shards, **bot_options)
+    asyncio.run(serve_shard(xp_bot, queue))
+
+
+async def serve_shard(xp_bot, queue):
+    app = xp_bot.app
+    async with app:
+        await xp_bot.post_init(app)
+        await app.start()
+        while True:
+            message = await asyncio.to_thread(queue.get)
+            if message is None:
+                break
+            command, data = message
+            if command == "update":
+                await app.update_queue.put(Update.de_json(data, app.bot))
+            elif command == "new_year":
+                xp_bot.run_in_background(xp_bot.send_new_year_message(app))
+        await app.stop()
+        await xp_bot.shutdown(app)
+
+
+class ShardCoordinator:
+    """Front process of a sharded deployment.
+
+    It receives the updates, by polling or webhook, and routes each of them
+    to the worker process owning its chat. It also triggers the operations
+    spanning every shard, like the new year message. A worker that dies is
+    restarted on the same queue, so the updates routed to it meanwhile are
+    handled once it is back.
+    """
+
+    def __init__(self, TOKEN, ERASE_NEW_YEAR, shards, bot_options=None,
+                 webhook=None) -> None:
+        self.shards = shards
+        self.webhook = webhook
+        self.worker_args = (TOKEN, ERASE_NEW_YEAR, bot_options or {})
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = [self.context.Queue() for _ in range(shards)]
+        self.workers = [self.spawn(shard) for shard in range(shards)]
+        # Time each worker was started, and how many times in a row it
+        # died shortly after
+        self.started_at = [None] * shards
+        self.crashes = [0] * shards
+
+        self.app = (
+            ApplicationBuilder()
+            .token(TOKEN)
+            .post_init(self.post_init)
+            .post_shutdown(self.shutdown)
+            .build()
+        )
+        self.app.add_handler(TypeHandler(Update, self.route))
+
+        self.scheduler = Scheduler()
+        self.scheduler.at("new_year", next_new_year, self.new_year)
+        self.scheduler.every("watch_workers", WATCH_INTERVAL,
+                             self.watch_workers)
+
+    def spawn(self, shard):
+        return self.context.Process(
+            target=run_shard,
+            args=(shard, self.shards, self.queues[shard], *self.worker_args),
+            name=f"xp-bot-shard{shard}",
+        )
+
+    def start_worker(self, shard):
+        self.workers[shard].start()
+        self.started_at[shard] = time.monotonic()
+
+    def run(self) -> None:
+        for shard in range(self.shards):
+            self.start_worker(shard)
+        if self.webhook is None:
+            self.app.run_polling()
+        else:
+            self.app.run_webhook(**self.webhook)
+
+    async def route(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Forward an update to the shard owning its chat"""
+        self.queues[shard_for(update, self.shards)].put(
+            ("update", update.to_dict())
+        )
+
+    def broadcast(self, command):
+        """Send a command to every shard"""
+        for queue in self.queues:
+            queue.put((command, None))
+
+    async def new_year(self, deadline):
+        self.broadcast("new_year")
+
+    async def watch_workers(self, deadline=None):
+        """Restart the workers that died, or stop everything if one keeps dying"""
+        for shard, worker in enumerate(self.workers):
+            if worker.is_alive():
+                continue
+            if time.monotonic() - self.started_at[shard] < CRASH_WINDOW:
+                self.crashes[shard] += 1
+            else:
+                self.crashes[shard] = 1
+            if self.crashes[shard] >= MAX_CRASHES:
+                logger.critical(
+                    f"{worker.name} exited with code {worker.exitcode} "
+                    f"{self.crashes[shard]} times in a row, stopping")
+                self.app.stop_running()
+                return
+            logger.error(
+                f"{worker.name} exited with code {worker.exitcode}, restarting it")
+            self.workers[shard] = self.spawn(shard)
+            self.start_worker(shard)
+
+    async def post_init(self, app) -> None:
+        self.scheduler.start()
+
+    async def shutdown(self, app) -> None:
+        """Stop the workers once they are done with their queued updates"""
+        await self.scheduler.stop()
+        for queue in self.queues:
+            queue.put(None)
+        for worker in self.workers:
+            if worker.pid is None:
+                continue
+            await asyncio.to_thread(worker.join, 30)
+            if worker.is_alive():
+                logger.warning(f"{worker.name} did not stop, terminating it")
+                worker.terminate()
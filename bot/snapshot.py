@@ -0,0 +1,35 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def write_json_atomic(path, data):
+    """Write `data` as JSON so that readers see either the old or the new file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def write_text_atomic(path, text):
+    """Write `text` so that readers see either the old or the new file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+
+def read_json(path, default=None):
+    """Load a snapshot written by write_json_atomic, `default` if unusable."""
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return default
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+
+from .outbox import TokenBucket
+
+# Verdicts of SenderThrottle.check
+ALLOW = 0
+NOTIFY = 1
+DROP = 2
+
+# XP changes a sender can make in a burst, and the seconds they take to
+# be available again
+DEFAULT_LIMIT = (5, 60)
+
+
+class SenderThrottle:
+    """Token bucket per (chat, sender) bounding how fast XP can be changed.
+
+    Chats can have their own (changes, seconds) limit. The first attempt
+    rejected in a burst gets NOTIFY so the sender is told once, the next
+    ones DROP until a change is allowed again. At most `max_entries`
+    buckets are kept, the idle full ones are forgotten first.
+    """
+
+    def __init__(self, default=DEFAULT_LIMIT, max_entries=50000):
+        self.default = default
+        self.max_entries = max_entries
+        # chat_id -> (changes, seconds)
+        self._limits = {}
+        # (chat_id, sender_id) -> [TokenBucket, notified], least recently used first
+        self._buckets = OrderedDict()
+        self.allowed = 0
+        self.notified = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def limit(self, chat_id):
+        return self._limits.get(chat_id, self.default)
+
+    def set_limit(self, chat_id, changes, seconds):
+        """Change the limit of a chat, None restores the default one."""
+        if changes is None:
+            self._limits.pop(chat_id, None)
+        else:
+            self._limits[chat_id] = (changes, seconds)
+        # Current buckets were sized for the previous limit
+        for key in [key for key in self._buckets if key[0] == chat_id]:
+            del self._buckets[key]
+
+    def load(self, limits):
+        """Restore the {chat_id: (changes, seconds)} limits of every chat."""
+        self._limits = dict(limits)
+
+    def check(self, chat_id, sender_id):
+        """Take a token of the sender, return ALLOW, NOTIFY or DROP."""
+        key = (chat_id, sender_id)
+        entry = self._buckets.pop(key, None)
+        if entry is None:
+            changes, seconds = self.limit(chat_id)
+            entry = [TokenBucket(changes / seconds, changes), False]
+        self._buckets[key] = entry
+        self._trim()
+
+        bucket = entry[0]
+        if bucket.wait_time() == 0:
+            bucket.take()
+            entry[1] = False
+            self.allowed += 1
+            return ALLOW
+        if not entry[1]:
+            entry[1] = True
+            self.notified += 1
+            return NOTIFY
+        self.dropped += 1
+        return DROP
+
+    def wait_time(self, chat_id, sender_id):
+        """Seconds before the sender can change XP again."""
+        entry = self._buckets.get((chat_id, sender_id))
+        return 0 if entry is None else entry[0].wait_time()
+
+    def trim(self):
+        """Forget the buckets that refilled, they would start full anyway."""
+        for key in [key for key, (bucket, _) in self._buckets.items()
+                    if bucket.is_full()]:
+            del self._buckets[key]
+
+    def _trim(self):
+        while len(self._buckets) > self.max_entries:
+            _, (oldest, _) = next(iter(self._buckets.items()))
+            if not oldest.is_full():
+                break
+            self._buckets.popitem(last=False)
+
+    def stats(self):
+        return {
+            "size": len(self._buckets),
+            "allowed": self.allowed,
+            "notified": self.notified,
+            "dropped": self.dropped,
+        }
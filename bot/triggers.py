@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# XP given by each trigger category of plus_minus.json, a trigger listed
+# in several categories counts for the first one
+TRIGGER_DELTAS = {
+    "simple_plus": 1,
+    "double_plus": 2,
+    "simple_minus": -1,
+    "double_minus": -2,
+}
+
+
+def compile_triggers(categories, base=None):
+    """Turn {category: [trigger, ...]} into a {trigger: xp_delta} map."""
+    table = dict(base or {})
+    # Later categories overwrite earlier ones, so insert the first last
+    for category, delta in reversed(TRIGGER_DELTAS.items()):
+        for trigger in categories.get(category, []):
+            table[trigger.lower()] = delta
+    return table
+
+
+def _check_categories(categories, where):
+    if not isinstance(categories, dict):
+        raise ValueError(f"{where} must be an object")
+    for category in TRIGGER_DELTAS:
+        triggers = categories.get(category, [])
+        if (not isinstance(triggers, list)
+                or not all(isinstance(t, str) for t in triggers)):
+            raise ValueError(f"{where}.{category} must be a list of strings")
+
+
+def parse_triggers(triggers):
+    """Compile the content of plus_minus.json into (table, chat_tables),
+    raising ValueError if it is malformed."""
+    _check_categories(triggers, "triggers")
+    chats = triggers.get("chats", {})
+    if not isinstance(chats, dict):
+        raise ValueError("triggers.chats must be an object")
+    table = compile_triggers(triggers)
+    chat_tables = {}
+    for chat_id, categories in chats.items():
+        _check_categories(categories, f"triggers.chats.{chat_id}")
+        chat_tables[int(chat_id)] = compile_triggers(categories, base=table)
+    return table, chat_tables
+
+
+class TriggerTable:
+    """Precompiled lookup of the XP triggers, reloaded when the file changes.
+
+    Besides the global categories, plus_minus.json may contain a "chats"
+    object mapping a chat id to extra categories for that chat only.
+    """
+
+    def __init__(self, path="./plus_minus.json", reload_interval=5.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._mtime = None
+        self._next_check = 0.0
+        self._table = {}
+        self._chat_tables = {}
+        self._max_length = 0
+        self._reload()
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path, "r") as file:
+                table, chat_tables = parse_triggers(json.load(file))
+        except (OSError, ValueError) as e:
+            # Keep serving the last good table if the file is being edited
+            # or malformed
+            logger.warning(f"Could not load triggers from {self.path}: {e}")
+            return False
+
+        self._table = table
+        self._chat_tables = chat_tables
+        self._max_length = max(
+            (len(trigger) for t in [table, *chat_tables.values()] for trigger in t),
+            default=0,
+        )
+        self._mtime = mtime
+        return True
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.reload_interval
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime != self._mtime and self._reload():
+            logger.info(f"Reloaded triggers from {self.path}")
+
+    def lookup(self, text, chat_id=None):
+        """Return the XP delta of a message, 0 if it is not a trigger."""
+        self._maybe_reload()
+        # Almost every message is longer than any trigger
+        if len(text) > self._max_length:
+            return 0
+        table = self._chat_tables.get(chat_id, self._table)
+        return table.get(text.lower(), 0)
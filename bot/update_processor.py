@@ -0,0 +1,52 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Limit given to the base class, whose semaphore is taken before the chat
+# lock and would let the queued updates of a busy chat hold every slot
+UNBOUNDED = 2 ** 31 - 1
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different chats concurrently.
+
+    Updates of the same chat still go through one at a time, in the order
+    they were received, so XP changes within a chat stay consistent. An
+    update only takes one of the `max_concurrent_updates` slots once it
+    holds its chat's lock, so a busy chat never holds back the others.
+    """
+
+    def __init__(self, max_concurrent_updates=32):
+        super().__init__(UNBOUNDED)
+        self.max_handlers = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # chat_id -> [lock, number of updates holding or waiting for it]
+        self._chat_locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat.id]
+
+    def in_progress(self):
+        """Number of updates being handled or waiting for their chat."""
+        return sum(entry[1] for entry in self._chat_locks.values())
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
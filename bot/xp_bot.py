@@ -6,69 +6,178 @@ from telegram.ext import (
     ContextTypes,
 )
 from telegram import Update
-from database_queries import XPDatabase
+from telegram.error import Forbidden, TelegramError
+from database_queries import AsyncXPDatabase, BACKENDS
+from database_queries.xp_database import day_of
+from .triggers import TriggerTable
+from .cooldowns import CooldownTracker
+from .throttle import SenderThrottle, DEFAULT_LIMIT, ALLOW, DROP
+from .message_tracker import MessageTracker
+from .notifier import XPNotifier, DEBOUNCE
+from .member_cache import MemberCache
+from .outbox import Outbox, GLOBAL_RATE, REPLY, DELETE, BROADCAST
+from .jobs import Scheduler, next_new_year
+from .metrics import InstrumentedRequest, Metrics, MetricsServer
+from .update_processor import ChatOrderedUpdateProcessor
+from .snapshot import read_json, write_json_atomic, write_text_atomic
 import os
 import json
-from collections import defaultdict
+import logging
+import math
+import time
 
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
 import asyncio
-import shutil
 from pytz import timezone
 
-from datetime import datetime, timedelta
+from datetime import datetime
 
 with open('./message_templates.json', 'r') as file:
     message_templates = json.load(file)
 
-with open('./plus_minus.json', 'r') as file:
-    plus_minus_triggers = json.load(file)
+triggers = TriggerTable('./plus_minus.json')
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two snapshots of the in-memory state
+STATE_SAVE_INTERVAL = 60
+
+# Seconds between two runs of the maintenance jobs. The database ones
+# share the worker thread with the handlers, so they work in short steps
+# and stop once their time budget is spent.
+MAINTENANCE_INTERVAL = 3600
+MAINTENANCE_BUDGET = 2.0
+CHECKPOINT_INTERVAL = 300
+CACHE_TRIM_INTERVAL = 300
+METRICS_FLUSH_INTERVAL = 15
+COMPACTION_BATCH = 5000
+VACUUM_PAGES = 256
+
+# Leaderboards over a time window, by /top argument, in days
+TOP_WINDOWS = {"week": 7, "month": 30}
+ROLLUP_RETENTION_DAYS = 2 * max(TOP_WINDOWS.values())
+
+# Stored full names older than this are refreshed after /top is sent
+NAME_TTL = 24 * 3600
+NAME_LOOKUP_CONCURRENCY = 5
+
+# Groups queued at once in the outbox by a broadcast, checkpointed per group
+BROADCAST_BATCH = 500
 
 
 class XP_Bot:
-    def __init__(self, TOKEN, ERASE_NEW_YEAR) -> None:
+    def __init__(self, TOKEN, ERASE_NEW_YEAR, db_options=None,
+                 member_cache_ttl=60, webhook=None,
+                 concurrent_updates=32, shard=None,
+                 event_retention_days=365, metrics_address=None,
+                 metrics_file=None, storage="sqlite", db_path=None,
+                 sender_rate_limit=DEFAULT_LIMIT, notify_mode="reply",
+                 notify_debounce=DEBOUNCE, global_rate=GLOBAL_RATE) -> None:
+        # When running as one shard out of several, the front process
+        # feeds the updates and triggers the new year, and every file
+        # gets a per-shard suffix
+        self.shard = shard
+        self.suffix = "" if shard is None else f".shard{shard}"
+
+        # Handlers, database and Telegram calls are always measured, the
+        # HTTP endpoint only runs when an address is given
+        self.metrics = Metrics()
+        self.metrics_server = None
+        if metrics_address is not None:
+            self.metrics_server = MetricsServer(self.metrics, *metrics_address)
+        # Or they are written to a file for the node exporter to pick up
+        self.metrics_file = None
+        if metrics_file is not None:
+            root, ext = os.path.splitext(metrics_file)
+            self.metrics_file = f"{root}{self.suffix}{ext}"
+
         # Start the app and start/load the database
-        self.app = ApplicationBuilder().token(TOKEN).build()
-        self.db = XPDatabase()
+        self.webhook = webhook
+        builder = (
+            ApplicationBuilder()
+            .token(TOKEN)
+            .request(InstrumentedRequest(self.metrics, connection_pool_size=256))
+            .concurrent_updates(ChatOrderedUpdateProcessor(concurrent_updates))
+            .post_init(self.post_init)
+            .post_shutdown(self.shutdown)
+        )
+        if shard is not None:
+            builder = builder.updater(None)
+        self.app = builder.build()
+        # SQLite by default, or the in-memory engine with its snapshot
+        root, ext = os.path.splitext(
+            db_path or f"./xp_data{BACKENDS[storage].extension}")
+        self.db_name = f"{root}{self.suffix}{ext}"
+        self.db_options = db_options or {}
+        self.db = AsyncXPDatabase(
+            self.db_name, metrics=self.metrics, backend=storage,
+            **self.db_options)
         self.groups = set()
-        self.scheduler = BackgroundScheduler(timezone=timezone("Europe/Paris"))
-        self.scheduler.start()
         self.erase_new_year = ERASE_NEW_YEAR
-
-        # Initlialize the dictionnary to track the cooldown
-        self.last_changed = {}
-        self.last_top = {}
-
-        # Initlialize the value of the last xp update and info messages to only keep one
-        self.last_xp_update = {}
-        self.last_xp_info = defaultdict(lambda: defaultdict(int))
+        self.event_retention_days = event_retention_days
+
+        # Restore the cooldowns saved before the last restart
+        self.cooldowns_path = f"./cooldowns{self.suffix}.json"
+        self.cooldowns = CooldownTracker()
+        self.cooldowns.load(read_json(self.cooldowns_path, []))
+
+        # Bound how fast each sender can change XP, before any API call or
+        # XP lookup, the per-chat limits are loaded with the database
+        self.throttle = SenderThrottle(sender_rate_limit)
+
+        # Cache chat members to spare Telegram API calls
+        self.members = MemberCache(ttl=member_cache_ttl)
+        self.name_lookups = asyncio.Semaphore(NAME_LOOKUP_CONCURRENCY)
+        self.background_tasks = set()
+
+        # Every outgoing message goes through the rate limited outbox
+        self.outbox = Outbox(global_rate=global_rate)
+
+        # Track the last xp update, top and info messages to only keep one
+        self.last_messages = MessageTracker()
+        self.last_messages_path = f"./last_messages{self.suffix}.json"
+        self.last_messages.load(read_json(self.last_messages_path, []))
+
+        # XP notifications answer each trigger with a new message replacing
+        # the previous one, or are merged into one status message edited
+        # at most once per debounce window
+        if notify_mode not in ("reply", "edit"):
+            raise ValueError(f"Unknown notification mode {notify_mode}")
+        self.notifier = None
+        if notify_mode == "edit":
+            self.notifier = XPNotifier(
+                self.outbox, self.last_messages, notify_debounce,
+                more=message_templates["xp"]["change_more"])
 
         # Add all the functionnality handlers
-        self.app.add_handler(CommandHandler("start", self.start))
+        self.app.add_handler(CommandHandler("start", self.timed(self.start)))
+        self.app.add_handler(
+            CommandHandler(
+                "enable", self.timed(self.enable), filters=filters.TEXT & filters.ChatType.GROUPS
+            )
+        )
         self.app.add_handler(
             CommandHandler(
-                "enable", self.enable, filters=filters.TEXT & filters.ChatType.GROUPS
+                "disable", self.timed(self.disable), filters=filters.TEXT & filters.ChatType.GROUPS
             )
         )
         self.app.add_handler(
             CommandHandler(
-                "disable", self.disable, filters=filters.TEXT & filters.ChatType.GROUPS
+                "xp", self.timed(self.check_xp), filters=filters.TEXT & filters.ChatType.GROUPS
             )
         )
         self.app.add_handler(
             CommandHandler(
-                "xp", self.check_xp, filters=filters.TEXT & filters.ChatType.GROUPS
+                "top", self.timed(self.top_users), filters=filters.TEXT & filters.ChatType.GROUPS
             )
         )
         self.app.add_handler(
             CommandHandler(
-                "top", self.top_users, filters=filters.TEXT & filters.ChatType.GROUPS
+                "setcooldown", self.timed(self.set_chat_cooldown), filters=filters.TEXT & filters.ChatType.GROUPS
             )
         )
         self.app.add_handler(
             CommandHandler(
-                "setcooldown", self.set_chat_cooldown, filters=filters.TEXT & filters.ChatType.GROUPS
+                "setlimit", self.timed(self.set_chat_rate_limit), filters=filters.TEXT & filters.ChatType.GROUPS
             )
         )
         self.app.add_handler(
@@ -77,30 +186,238 @@ class XP_Bot:
                 & (~filters.COMMAND)
                 & (~filters.UpdateType.EDITED)
                 & filters.ChatType.GROUPS,
-                self.change_xp,
+                self.timed(self.change_xp),
             )
         )
         self.app.add_handler(
             MessageHandler(
                 filters.ChatType.GROUPS & filters.StatusUpdate.LEFT_CHAT_MEMBER,
-                self.left_chat,
+                self.timed(self.left_chat),
             )
         )
         self.app.add_handler(
             MessageHandler(
                 filters.StatusUpdate.NEW_CHAT_MEMBERS,
-                self.added_to_group,
+                self.timed(self.added_to_group),
             )
         )
 
-        self.schedule_new_year_message()
+        self.register_metrics()
+
+        # Periodic jobs, run on the event loop once the bot is started
+        self.scheduler = Scheduler(self.metrics)
+        self.schedule_jobs()
 
     def run(self) -> None:
-        self.app.run_polling()
+        if self.webhook is None:
+            self.app.run_polling()
+        else:
+            # Telegram pushes the updates to a local HTTP server instead
+            self.app.run_webhook(**self.webhook)
+
+    def timed(self, callback):
+        """Wrap a handler to record its latency and failures"""
+        name = callback.__name__
+
+        async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            start = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                self.metrics.inc("xp_bot_handler_errors_total", handler=name)
+                raise
+            finally:
+                self.metrics.observe("xp_bot_handler_seconds",
+                                     time.perf_counter() - start, handler=name)
+
+        handler.__name__ = name
+        return handler
+
+    def register_metrics(self) -> None:
+        """Expose the queues and caches of the bot as metrics read on scrape"""
+        metrics = self.metrics
+        metrics.describe("xp_bot_handler_seconds", "histogram",
+                         "Time spent in each update handler")
+        metrics.describe("xp_bot_handler_errors_total", "counter",
+                         "Handlers that raised an exception")
+        metrics.describe("xp_bot_db_query_seconds", "histogram",
+                         "Time spent in each database method on the worker")
+        metrics.describe("xp_bot_db_errors_total", "counter",
+                         "Database methods that raised an exception")
+        metrics.describe("xp_bot_telegram_request_seconds", "histogram",
+                         "Duration of the Bot API requests by method")
+        metrics.describe("xp_bot_telegram_errors_total", "counter",
+                         "Failed Bot API requests by method and error")
+        metrics.describe("xp_bot_job_seconds", "histogram",
+                         "Duration of each run of the scheduled jobs")
+        metrics.describe("xp_bot_job_errors_total", "counter",
+                         "Scheduled job runs that raised an exception")
+
+        metrics.gauge(
+            "xp_bot_outbox_pending", "Jobs waiting in the outbox",
+            lambda: [({"priority": "reply"}, self.outbox.depth(REPLY)),
+                     ({"priority": "delete"}, self.outbox.depth(DELETE)),
+                     ({"priority": "broadcast"}, self.outbox.depth(BROADCAST))])
+        metrics.gauge(
+            "xp_bot_outbox_jobs_total", "Outbox jobs by outcome",
+            lambda: [({"result": result}, self.outbox.stats()[result])
+                     for result in ("sent", "retried", "failed", "dropped")],
+            kind="counter")
+        metrics.gauge(
+            "xp_bot_outbox_last_delay_seconds",
+            "Time the last finished outbox job spent queued",
+            lambda: self.outbox.last_delay)
+        metrics.gauge(
+            "xp_bot_update_queue_size", "Updates received but not dispatched",
+            lambda: self.app.update_queue.qsize())
+        metrics.gauge(
+            "xp_bot_updates_in_progress",
+            "Updates being handled or waiting for their chat",
+            lambda: self.app.update_processor.in_progress())
+        metrics.gauge(
+            "xp_bot_background_tasks", "Background tasks still running",
+            lambda: len(self.background_tasks))
+        if self.notifier is not None:
+            metrics.gauge(
+                "xp_bot_xp_notifications_total",
+                "XP notifications merged, and summaries edited or sent",
+                lambda: [({"result": result}, self.notifier.stats()[result])
+                         for result in ("added", "edited", "sent", "failed")],
+                kind="counter")
+        metrics.gauge(
+            "xp_bot_sender_throttle_total", "XP change attempts by throttle verdict",
+            lambda: [({"result": result}, self.throttle.stats()[result])
+                     for result in ("allowed", "notified", "dropped")],
+            kind="counter")
+
+        def cache_lookups():
+            member, settings = self.members.stats(), self.db.settings_stats()
+            return [
+                ({"cache": "member", "result": "hit"}, member["hits"]),
+                ({"cache": "member", "result": "coalesced"}, member["coalesced"]),
+                ({"cache": "member", "result": "miss"}, member["misses"]),
+                ({"cache": "settings", "result": "hit"}, settings["hits"]),
+                ({"cache": "settings", "result": "miss"}, settings["misses"]),
+            ]
+
+        metrics.gauge("xp_bot_cache_lookups_total", "Cache lookups by outcome",
+                      cache_lookups, kind="counter")
+        metrics.gauge(
+            "xp_bot_cache_entries", "Entries held by each in-memory cache",
+            lambda: [({"cache": "member"}, len(self.members)),
+                     ({"cache": "settings"}, self.db.settings_stats()["size"]),
+                     ({"cache": "cooldowns"}, len(self.cooldowns)),
+                     ({"cache": "throttle"}, len(self.throttle)),
+                     ({"cache": "last_messages"}, len(self.last_messages))])
+
+    async def post_init(self, app) -> None:
+        """Start the background services once the event loop is running"""
+        await self.db.start()
+        self.groups = set(await self.db.get_groups())
+        self.throttle.load(await self.db.get_chat_rate_limits())
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        self.outbox.start(app.bot)
+        self.scheduler.start()
+        # Finish the broadcasts a restart interrupted
+        for name in await self.db.get_unfinished_broadcasts():
+            self.run_in_background(self.run_broadcast(name))
+
+    async def shutdown(self, app) -> None:
+        """Save the state and release the database once the application has stopped"""
+        await self.scheduler.stop()
+        if self.background_tasks:
+            await asyncio.wait(self.background_tasks, timeout=10)
+        if self.notifier is not None:
+            await self.notifier.stop()
+        await self.outbox.stop()
+        if self.background_tasks:
+            # Broadcasts still waiting on the outbox are cancelled with it
+            await asyncio.wait(self.background_tasks, timeout=1)
+        await self.save_state()
+        await self.db.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        logger.info(f"Member cache stats: {self.members.stats()}")
+        logger.info(f"Outbox stats: {self.outbox.stats()}")
+
+    async def save_state(self) -> None:
+        """Snapshot the in-memory state that must survive a restart"""
+        cooldowns = self.cooldowns.dump()
+        last_messages = self.last_messages.dump()
+        try:
+            await asyncio.to_thread(
+                write_json_atomic, self.cooldowns_path, cooldowns
+            )
+            await asyncio.to_thread(
+                write_json_atomic, self.last_messages_path, last_messages
+            )
+        except OSError as e:
+            logger.warning(f"Could not save state: {e}")
+
+    def schedule_jobs(self) -> None:
+        scheduler = self.scheduler
+        scheduler.every("save_state", STATE_SAVE_INTERVAL,
+                        lambda deadline: self.save_state())
+        scheduler.every("compact_history", MAINTENANCE_INTERVAL,
+                        self.compact_history, MAINTENANCE_BUDGET)
+        scheduler.every("optimize_database", MAINTENANCE_INTERVAL,
+                        self.optimize_database, MAINTENANCE_BUDGET)
+        scheduler.every("checkpoint", CHECKPOINT_INTERVAL,
+                        lambda deadline: self.db.checkpoint(), MAINTENANCE_BUDGET)
+        scheduler.every("trim_caches", CACHE_TRIM_INTERVAL,
+                        self.trim_caches, MAINTENANCE_BUDGET)
+        if self.metrics_file is not None:
+            scheduler.every("flush_metrics", METRICS_FLUSH_INTERVAL,
+                            self.flush_metrics, MAINTENANCE_BUDGET)
+        # With shards, the front process triggers the new year on every worker
+        if self.shard is None:
+            scheduler.at("new_year", next_new_year,
+                         lambda deadline: self.send_new_year_message(self.app))
+
+    async def compact_history(self, deadline=None) -> None:
+        """Drop the XP history and daily rollups older than their retention period"""
+        now = time.time()
+        before = now - self.event_retention_days * 24 * 3600
+        # Small batches so handlers can use the database in between, what
+        # is left past the deadline goes at the next run
+        deleted = COMPACTION_BATCH
+        while deleted == COMPACTION_BATCH and not self.past(deadline):
+            deleted = await self.db.compact_xp_events(before, COMPACTION_BATCH)
+
+        before_day = day_of(now) - ROLLUP_RETENTION_DAYS
+        deleted = COMPACTION_BATCH
+        while deleted == COMPACTION_BATCH and not self.past(deadline):
+            deleted = await self.db.compact_xp_daily(before_day, COMPACTION_BATCH)
+
+    async def optimize_database(self, deadline=None) -> None:
+        """Refresh the planner statistics and give the free pages back"""
+        await self.db.optimize()
+        while (not self.past(deadline)
+               and await self.db.incremental_vacuum(VACUUM_PAGES)):
+            pass
+
+    async def trim_caches(self, deadline=None) -> None:
+        """Drop the expired entries the caches would otherwise keep until evicted"""
+        self.members.trim()
+        self.cooldowns.trim()
+        self.throttle.trim()
+        self.last_messages.trim()
+
+    async def flush_metrics(self, deadline=None) -> None:
+        try:
+            await asyncio.to_thread(
+                write_text_atomic, self.metrics_file, self.metrics.render())
+        except OSError as e:
+            logger.warning(f"Could not write metrics: {e}")
+
+    @staticmethod
+    def past(deadline):
+        return deadline is not None and time.monotonic() >= deadline
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Prompt message when you start the bot"""
-        await context.bot.send_message(
+        self.outbox.send_message(
             chat_id=update.effective_chat.id,
             text=message_templates["admin"]["greeting"]
         )
@@ -108,24 +425,36 @@ class XP_Bot:
     async def added_to_group(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Prompt message when you add the bot to a group"""
         chat_id = update.message.chat_id
-        self.groups.add(chat_id)
 
         for member in update.message.new_chat_members:
+            self.members.invalidate(chat_id, member.id)
             if member.is_bot and member.id == context.bot.id:
-                await context.bot.send_message(
+                await self.register_group(chat_id, update.message.from_user.id)
+                self.outbox.send_message(
                     chat_id=update.effective_chat.id,
                     text=message_templates["admin"]["group_greeting"]
                 )
+        if chat_id not in self.groups:
+            await self.register_group(chat_id)
+
+    async def register_group(self, chat_id, added_by=None):
+        self.groups.add(chat_id)
+        await self.db.register_group(chat_id, added_by)
+
+    async def forget_group(self, chat_id):
+        self.groups.discard(chat_id)
+        await self.db.remove_group(chat_id)
 
     async def enable(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Command to enable the XP functionnality in a given group"""
         user_id = update.message.from_user.id
         chat_id = update.message.chat_id
-        member = await context.bot.get_chat_member(chat_id, user_id)
+        member = await self.members.get(context.bot, chat_id, user_id,
+                                        fresh=True)
 
         # Do nothing if already ON
-        if self.db.is_chat_enabled(chat_id):
-            await context.bot.send_message(
+        if await self.db.is_chat_enabled(chat_id):
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message_templates["admin"]["enabled_already"]
@@ -133,22 +462,22 @@ class XP_Bot:
 
         # Do nothing if user doesn't have the necessary rights
         elif member.status not in ["creator", "administrator"]:
-            await context.bot.send_message(
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message_templates["admin"]["enabled_no_rights"]
             )
 
         else:
-            success = self.db.enable_chat(chat_id)
+            success = await self.db.enable_chat(chat_id)
             if success:
-                await context.bot.send_message(
+                self.outbox.send_message(
                     chat_id=update.effective_chat.id,
                     reply_to_message_id=update.message.id,
                     text=message_templates["admin"]["enabled"]
                 )
             else:
-                await context.bot.send_message(
+                self.outbox.send_message(
                     chat_id=update.effective_chat.id,
                     reply_to_message_id=update.message.id,
                     text=message_templates["admin"]["enabled_runtime_error"]
@@ -158,11 +487,12 @@ class XP_Bot:
         """Command to disable the XP functionnality in a given group"""
         user_id = update.message.from_user.id
         chat_id = update.message.chat_id
-        member = await context.bot.get_chat_member(chat_id, user_id)
+        member = await self.members.get(context.bot, chat_id, user_id,
+                                        fresh=True)
 
         # Do nothing if already OFF
-        if not self.db.is_chat_enabled(chat_id):
-            await context.bot.send_message(
+        if not await self.db.is_chat_enabled(chat_id):
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message_templates["admin"]["disabled_already"]
@@ -171,22 +501,22 @@ class XP_Bot:
 
         # Do nothing if user doesn't have the necessary rights
         if member.status not in ["creator", "administrator"]:
-            await context.bot.send_message(
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message_templates["admin"]["disabled_no_rights"]
             )
             return
 
-        success = self.db.disable_chat(chat_id)
+        success = await self.db.disable_chat(chat_id)
         if success:
-            await context.bot.send_message(
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message_templates["admin"]["disabled"]
             )
         else:
-            await context.bot.send_message(
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message_templates["admin"]["disabled_runtime_error"]
@@ -197,19 +527,20 @@ class XP_Bot:
         chat_id = update.message.chat_id
 
         # Check if the chat is enabled for XP tracking
-        if not self.db.is_chat_enabled(chat_id):
-            await context.bot.send_message(
+        if not await self.db.is_chat_enabled(chat_id):
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message_templates["warn"]
             )
             return
 
-        member = await context.bot.get_chat_member(chat_id, user_id)
+        member = await self.members.get(context.bot, chat_id, user_id,
+                                        fresh=True)
 
         # Do nothing if user doesn't have the necessary rights
         if member.status not in ["creator", "administrator"]:
-            await context.bot.send_message(
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message_templates["admin"]["cooldown_no_rights"]
@@ -217,7 +548,7 @@ class XP_Bot:
             return
 
         if len(context.args) != 1:
-            await context.bot.send_message(
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message_templates["admin"]["cooldown_error"]
@@ -225,7 +556,7 @@ class XP_Bot:
             return
 
         if not context.args[0].isdigit() or int(context.args[0]) < 0 or int(context.args[0]) > 86400:
-            await context.bot.send_message(
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message_templates["admin"]["cooldown_error"]
@@ -233,17 +564,76 @@ class XP_Bot:
             return
 
         seconds = int(context.args[0])
-        success = self.db.set_chat_cooldown(chat_id, seconds)
+        success = await self.db.set_chat_cooldown(chat_id, seconds)
 
         if success:
-            await context.bot.send_message(
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message_templates["admin"]["cooldown_status"].format(
                     cooldown=seconds)
             )
         else:
-            await context.bot.send_message(
+            self.outbox.send_message(
+                chat_id=update.effective_chat.id,
+                reply_to_message_id=update.message.id,
+                text=message_templates["admin"]["disabled_runtime_error"]
+            )
+
+    async def set_chat_rate_limit(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handler for /setlimit <changes> <seconds>, or /setlimit default"""
+        user_id = update.message.from_user.id
+        chat_id = update.message.chat_id
+
+        # Check if the chat is enabled for XP tracking
+        if not await self.db.is_chat_enabled(chat_id):
+            self.outbox.send_message(
+                chat_id=update.effective_chat.id,
+                reply_to_message_id=update.message.id,
+                text=message_templates["warn"]
+            )
+            return
+
+        member = await self.members.get(context.bot, chat_id, user_id,
+                                        fresh=True)
+
+        # Do nothing if user doesn't have the necessary rights
+        if member.status not in ["creator", "administrator"]:
+            self.outbox.send_message(
+                chat_id=update.effective_chat.id,
+                reply_to_message_id=update.message.id,
+                text=message_templates["admin"]["limit_no_rights"]
+            )
+            return
+
+        if context.args == ["default"]:
+            changes, seconds = None, None
+        elif (len(context.args) == 2
+              and all(arg.isdigit() for arg in context.args)
+              and 1 <= int(context.args[0]) <= 1000
+              and 1 <= int(context.args[1]) <= 86400):
+            changes, seconds = int(context.args[0]), int(context.args[1])
+        else:
+            self.outbox.send_message(
+                chat_id=update.effective_chat.id,
+                reply_to_message_id=update.message.id,
+                text=message_templates["admin"]["limit_error"]
+            )
+            return
+
+        success = await self.db.set_chat_rate_limit(chat_id, changes, seconds)
+
+        if success:
+            self.throttle.set_limit(chat_id, changes, seconds)
+            changes, seconds = self.throttle.limit(chat_id)
+            self.outbox.send_message(
+                chat_id=update.effective_chat.id,
+                reply_to_message_id=update.message.id,
+                text=message_templates["admin"]["limit_status"].format(
+                    changes=changes, seconds=seconds)
+            )
+        else:
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message_templates["admin"]["disabled_runtime_error"]
@@ -256,65 +646,81 @@ class XP_Bot:
         username = update.message.from_user.username
 
         # Check if the chat is enabled for XP tracking
-        if not self.db.is_chat_enabled(chat_id):
+        if not await self.db.is_chat_enabled(chat_id):
             answer = message_templates["warn"]
 
+        # /xp all adds up every season and yearly archive
+        elif context.args and context.args[0].lower() == "all":
+            xp = await self.db.get_all_time_user_xp(chat_id, user_id)
+            answer = message_templates["xp"]["xp_status_all"].format(
+                name=username, xp=xp)
+
         else:
             # Get the user's XP and level
-            xp = self.db.get_user_xp(chat_id, user_id)
+            xp = await self.db.get_user_xp(chat_id, user_id)
             answer = message_templates["xp"]["xp_status"].format(
                 name=username, xp=xp)
 
-        new_message = await context.bot.send_message(
+        self.outbox.send_message(
             chat_id=update.effective_chat.id,
             reply_to_message_id=update.message.id,
             text=answer,
-        )
-
-        await self.delete_refresh_xp_info(
-            new_message.message_id, chat_id, user_id, context
+            on_sent=lambda new_message: self.delete_refresh_xp_info(
+                new_message.message_id, chat_id, user_id, context),
         )
 
     async def change_xp(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handler to change the xp"""
         message = update.message
-
-        message_text = message.text.lower()
         chat_id = message.chat_id
 
-        self.groups.add(chat_id)
-
-        simple_plus_triggers = plus_minus_triggers["simple_plus"]
-        simple_minus_triggers = plus_minus_triggers["simple_minus"]
-        double_minus_triggers = plus_minus_triggers["double_minus"]
-        double_plus_triggers = plus_minus_triggers["double_plus"]
-
-        plus_triggers = simple_plus_triggers + double_plus_triggers
-        minus_triggers = simple_minus_triggers + double_minus_triggers
-
-        all_triggers = plus_triggers + minus_triggers
+        if chat_id not in self.groups:
+            await self.register_group(chat_id)
 
         # Only check messages that are exactly one of the accepted
-        if message_text not in all_triggers:
+        xp_amount = triggers.lookup(message.text, chat_id)
+        if xp_amount == 0:
             return
 
         # Do nothing if the chat is not enabled
-        elif not self.db.is_chat_enabled(chat_id):
-            await context.bot.send_message(
+        if not await self.db.is_chat_enabled(chat_id):
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message_templates["warn"]
             )
+            return
+
+        # Senders over their rate limit are told once per burst, the rest
+        # of the burst is dropped before any member lookup. Only votes for
+        # someone else count, the other triggers are ignored.
+        reply = message.reply_to_message
+        if (reply is not None and reply.from_user is not None
+                and reply.from_user.id != message.from_user.id
+                and not reply.from_user.is_bot):
+            verdict = self.throttle.check(chat_id, message.from_user.id)
+            if verdict == DROP:
+                return
+            elif verdict != ALLOW:
+                await self.notify_xp_update(
+                    update, context, ("throttled", message.from_user.id),
+                    message_templates["xp"]["throttled"].format(
+                        name=message.from_user.name,
+                        time=math.ceil(self.throttle.wait_time(
+                            chat_id, message.from_user.id)))
+                )
+                return
 
         # Only take into account messages that answer others
-        elif message.reply_to_message:
+        if message.reply_to_message:
             # Get info from the sender
             sender_id = message.from_user.id
             sender_name = message.from_user.name
 
             # Get info from the reciever
             reciever_id = message.reply_to_message.from_user.id
-            reciever_user = await update.effective_chat.get_member(reciever_id)
+            reciever_user = await self.members.get(
+                context.bot, chat_id, reciever_id)
             reciever_status = reciever_user.status
             reciever_name = message.reply_to_message.from_user.name
 
@@ -326,120 +732,125 @@ class XP_Bot:
                 # Don't allow people to change xp of people who got banned or left
                 return
 
-            xp_amount = 0
-            old_reciever_xp = self.db.get_user_xp(chat_id, reciever_id)
-            sender_xp = self.db.get_user_xp(chat_id, sender_id)
-
-            chat_cooldown = timedelta(
-                seconds=self.db.get_chat_cooldown(chat_id))
-
-            if message_text in simple_plus_triggers:
-                xp_amount = 1
-            elif message_text in double_plus_triggers:
-                xp_amount = 2
-            elif message_text in simple_minus_triggers:
-                xp_amount = -1
-            elif message_text in double_minus_triggers:
-                xp_amount = -2
-            if xp_amount != 0:
-
-                # Check that delay is ok
-                last_change_time = self.last_changed.get(
-                    (sender_id, reciever_id), datetime.min
-                )
-                elapsed_time = datetime.now() - last_change_time
-                if elapsed_time < chat_cooldown:
-                    new_message = await context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        reply_to_message_id=update.message.id,
-                        text=message_templates["xp"]["wait"].format(
-                            time=int((chat_cooldown - elapsed_time).total_seconds()), name=reciever_name)
-                    )
-                    await self.delete_refresh_xp_update(
-                        new_message.message_id, chat_id, context
-                    )
-                    return
-
-                self.last_changed[(sender_id, reciever_id)] = datetime.now()
-
-                self.db.update_user_xp(chat_id, reciever_id, xp_amount)
-                sender_medal = self.db.get_medal(
-                    chat_id=chat_id, user_id=sender_id)
-                reciever_medal = self.db.get_medal(
-                    chat_id=chat_id, user_id=reciever_id)
-
-                new_message = await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    reply_to_message_id=update.message.id,
-                    text=message_templates["xp"]["change"].format(sender_medal=sender_medal, sender_name=sender_name, sender_xp=sender_xp,
-                                                                  reciever_medal=reciever_medal, reciever_name=reciever_name, reciever_xp=old_reciever_xp+xp_amount)
-                )
+            old_reciever_xp = await self.db.get_user_xp(chat_id, reciever_id)
+            sender_xp = await self.db.get_user_xp(chat_id, sender_id)
 
-                await self.delete_refresh_xp_update(
-                    new_message.message_id, chat_id, context
-                )
+            chat_cooldown = await self.db.get_chat_cooldown(chat_id)
 
-                # Update the full name of the reciever with the last known value
-                self.db.refresh_username(
-                    chat_id, reciever_id, reciever_user.user.full_name
+            # Check that delay is ok
+            remaining = self.cooldowns.remaining(
+                chat_id, sender_id, reciever_id, chat_cooldown
+            )
+            if remaining > 0:
+                await self.notify_xp_update(
+                    update, context, ("wait", sender_id, reciever_id),
+                    message_templates["xp"]["wait"].format(
+                        time=int(remaining), name=reciever_name)
                 )
+                return
 
-    async def delete_refresh_xp_update(self, new_msg_id, chat_id, context):
-        if chat_id in self.last_xp_update:
-            # Delete last sent xp update message
-            await context.bot.delete_message(
-                chat_id=chat_id, message_id=self.last_xp_update[chat_id]
-            )
-        # Keep in track the latest xp change message id
-        self.last_xp_update[chat_id] = new_msg_id
-
-    async def delete_refresh_top(self, new_msg_id, chat_id, context):
-        if chat_id in self.last_top:
-            # Delete last sent top message
-            await context.bot.delete_message(
-                chat_id=chat_id, message_id=self.last_top[chat_id]
-            )
-        # Keep in track the latest top message id
-        self.last_top[chat_id] = new_msg_id
-
-    async def delete_refresh_xp_info(self, new_msg_id, chat_id, user_id, context):
-        if chat_id in self.last_xp_info:
-            if user_id in self.last_xp_info[chat_id]:
-                # Delete last sent top message
-                await context.bot.delete_message(
-                    chat_id=chat_id, message_id=self.last_xp_info[chat_id][user_id]
-                )
-        # Keep in track the latest top message id
-        self.last_xp_info[chat_id][user_id] = new_msg_id
+            self.cooldowns.touch(chat_id, sender_id, reciever_id, chat_cooldown)
+
+            await self.db.update_user_xp(
+                chat_id, reciever_id, xp_amount, sender_id=sender_id)
+            sender_medal = await self.db.get_medal(
+                chat_id=chat_id, user_id=sender_id)
+            reciever_medal = await self.db.get_medal(
+                chat_id=chat_id, user_id=reciever_id)
+
+            await self.notify_xp_update(
+                update, context, ("change", sender_id, reciever_id),
+                message_templates["xp"]["change"].format(sender_medal=sender_medal, sender_name=sender_name, sender_xp=sender_xp,
+                                                         reciever_medal=reciever_medal, reciever_name=reciever_name, reciever_xp=old_reciever_xp+xp_amount)
+            )
+
+            # Update the full name of the reciever with the last known value
+            await self.db.refresh_username(
+                chat_id, reciever_id, reciever_user.user.full_name
+            )
+
+    async def notify_xp_update(self, update, context, key, text):
+        """Answer an XP trigger, or queue `text` for the chat's status
+        message in edit mode, replacing the queued line with the same key"""
+        chat_id = update.message.chat_id
+        if self.notifier is not None:
+            self.notifier.add(chat_id, key, text)
+            return
+
+        self.outbox.send_message(
+            chat_id=update.effective_chat.id,
+            reply_to_message_id=update.message.id,
+            text=text,
+            on_sent=lambda new_message: self.delete_refresh_xp_update(
+                new_message.message_id, chat_id, context),
+        )
+
+    def delete_refresh(self, key, new_msg_id, chat_id, context):
+        # Keep in track the latest message id of this kind
+        last_msg_id = self.last_messages.replace(key, new_msg_id)
+        if last_msg_id is not None:
+            # Delete the previous one in the background
+            self.outbox.delete_message(chat_id, last_msg_id)
+
+    def delete_refresh_xp_update(self, new_msg_id, chat_id, context):
+        self.delete_refresh(("xp_update", chat_id), new_msg_id, chat_id, context)
+
+    def delete_refresh_top(self, new_msg_id, chat_id, context):
+        self.delete_refresh(("top", chat_id), new_msg_id, chat_id, context)
+
+    def delete_refresh_xp_info(self, new_msg_id, chat_id, user_id, context):
+        self.delete_refresh(
+            ("xp_info", chat_id, user_id), new_msg_id, chat_id, context
+        )
 
     async def top_users(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handler to display top users and ratings"""
         chat_id = update.message.chat_id
 
         # Do nothing if the chat is not enabled
-        if not self.db.is_chat_enabled(chat_id):
-            await context.bot.send_message(
+        if not await self.db.is_chat_enabled(chat_id):
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message_templates["warn"]
             )
 
         else:
-            top_users = self.db.get_top_users(chat_id=chat_id, limit=10)
-            message = message_templates["xp"]["popular"] + "\n"
+            # /top week and /top month rank the XP earned recently
+            window = context.args[0].lower() if context.args else None
+            if window == "all":
+                # /top all adds up every season and yearly archive
+                top_users = await self.db.get_all_time_top_users(
+                    chat_id=chat_id, limit=10)
+                title = message_templates["xp"]["popular_all"]
+            elif window in TOP_WINDOWS:
+                top_users = await self.db.get_window_top_users(
+                    chat_id=chat_id, days=TOP_WINDOWS[window], limit=10)
+                title = message_templates["xp"][f"popular_{window}"]
+            else:
+                top_users = await self.db.get_top_users(chat_id=chat_id, limit=10)
+                title = message_templates["xp"]["popular"]
+            user_ids = [user_id for user_id, _ in top_users]
+
+            # Render from the stored names, only asking Telegram for the
+            # missing ones and refreshing the stale ones in the background
+            stored = await self.db.get_stored_usernames(chat_id, user_ids)
+            now = time.time()
+            names = {user_id: name for user_id, (name, _) in stored.items()}
+            missing = [user_id for user_id in user_ids if names.get(user_id) is None]
+            stale = [
+                user_id for user_id in user_ids
+                if user_id in stored and now - stored[user_id][1] > NAME_TTL
+            ]
+            names.update(await self.resolve_names(chat_id, missing, context))
+            if stale:
+                self.run_in_background(self.resolve_names(chat_id, stale, context))
+
+            message = title + "\n"
 
             for i, (user_id, xp) in enumerate(top_users):
                 # Format each line
-                try:
-                    # Try to talk directly to Telegram's API
-                    member = await context.bot.get_chat_member(chat_id, user_id)
-                    full_name = member.user.full_name
-                except Exception as e:
-                    # If it fails, load the user full name from the stored db
-                    full_name = self.db.get_stored_username_by_user_id(
-                        chat_id, user_id)
-                if full_name is None:
-                    pass
+                full_name = names.get(user_id)
                 medal = str(i + 1)
                 if i == 0:
                     medal = "🥇"
@@ -452,56 +863,84 @@ class XP_Bot:
             if len(top_users) == 0:
                 message += message_templates["xp"]["popular_empty"]
 
-            new_message = await context.bot.send_message(
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message,
+                on_sent=lambda new_message: self.delete_refresh_top(
+                    new_message.message_id, chat_id, context),
             )
 
-            await self.delete_refresh_top(new_message.message_id, chat_id, context)
+    async def resolve_names(self, chat_id, user_ids, context):
+        """Fetch the full names of users concurrently and store them"""
+        async def resolve(user_id):
+            async with self.name_lookups:
+                try:
+                    member = await self.members.get(context.bot, chat_id, user_id)
+                except Exception as e:
+                    logger.warning(f"Could not resolve user {user_id}: {e}")
+                    return user_id, None
+            await self.db.refresh_username(chat_id, user_id, member.user.full_name)
+            return user_id, member.user.full_name
 
-    async def send_new_year_message(self, context):
-        current_year = datetime.now().year
+        results = await asyncio.gather(*(resolve(user_id) for user_id in user_ids))
+        return {user_id: name for user_id, name in results if name is not None}
 
-        for chat_id in self.groups:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=message_templates["admin"]["new_year_greeting"].format(
-                    year=current_year)
-            )
+    def run_in_background(self, coroutine):
+        # Keep a reference so the task isn't garbage collected mid-way
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def send_new_year_message(self, context):
+        current_year = datetime.now(timezone("Europe/Paris")).year
+        text = message_templates["admin"]["new_year_greeting"].format(
+            year=current_year)
 
         if self.erase_new_year:
-            for chat_id in self.groups:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=message_templates["admin"]["new_year_deletion"]
-                )
+            text += "\n\n" + message_templates["admin"]["new_year_deletion"]
             try:
-                shutil.move("./xp_data.db", f"./xp_data_{current_year}.db")
-                print("File moved successfully.")
-                self.db = XPDatabase()
+                # Archive last year's XP inside the live database
+                await self.db.start_new_season(str(current_year - 1))
+                logger.info(f"Season {current_year - 1} archived.")
             except Exception as e:
-                print(f"Error moving file: {e}")
+                logger.error(f"Error archiving season {current_year - 1}: {e}")
 
-    # Wrapper function for APScheduler
-    def send_new_year_message_job(self, app, loop):
-        asyncio.run_coroutine_threadsafe(
-            self.send_new_year_message(app),
-            loop
-        )
+        await self.db.start_broadcast(f"new_year_{current_year}", text)
+        await self.run_broadcast(f"new_year_{current_year}")
 
-    def schedule_new_year_message(self):
-        loop = asyncio.get_event_loop()
-        self.scheduler.add_job(
-            self.send_new_year_message_job,
-            CronTrigger(
-                month=1, day=1, hour=0, minute=0, second=0,
-                timezone=timezone("Europe/Paris")
-            ),
-            args=[self.app, loop],
-            id="new_year_greeting",
-            replace_existing=True
-        )
+    async def run_broadcast(self, name):
+        """Send a recorded broadcast to every group it didn't reach yet.
+
+        Each group is checkpointed once done, so a broadcast interrupted
+        by a restart resumes without sending twice. The outbox keeps the
+        sends under the Telegram rate limits.
+        """
+        broadcast = await self.db.get_broadcast(name)
+        if broadcast is None or broadcast[1] is not None:
+            return
+        text = broadcast[0]
+        sent = failed = 0
+        while pending := await self.db.get_broadcast_pending(name, BROADCAST_BATCH):
+            results = await asyncio.gather(
+                *(self.broadcast_to(name, chat_id, text) for chat_id in pending))
+            sent += sum(results)
+            failed += len(results) - sum(results)
+        await self.db.finish_broadcast(name)
+        logger.info(f"Broadcast {name} sent to {sent} groups, {failed} failed")
+
+    async def broadcast_to(self, name, chat_id, text):
+        ok = False
+        try:
+            await self.outbox.call("send_message", chat_id, BROADCAST, text=text)
+            ok = True
+        except Forbidden:
+            # The bot was removed from the group without seeing it
+            await self.forget_group(chat_id)
+        except TelegramError as e:
+            logger.warning(f"Broadcast {name} to {chat_id} failed: {e}")
+        await self.db.mark_broadcast_sent(name, chat_id, ok)
+        return ok
 
     async def left_chat(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handler to reset the rating when someone leaves the chat"""
@@ -509,9 +948,15 @@ class XP_Bot:
         chat_id = update.message.chat_id
         user_id = user.id
         user_name = user.name
-        self.db.remove_user(user_id, chat_id)
-        if user_id != context.bot.id:
-            await context.bot.send_message(
+        if user_id == context.bot.id:
+            self.members.invalidate(chat_id)
+        else:
+            self.members.invalidate(chat_id, user_id)
+        await self.db.remove_user(user_id, chat_id)
+        if user_id == context.bot.id:
+            await self.forget_group(chat_id)
+        else:
+            self.outbox.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.id,
                 text=message_templates["admin"]["leave"].format(name=user_name)
@@ -1 +1,4 @@
+from .storage import XPStorage
 from .xp_database import XPDatabase
+from .memory_xp_database import MemoryXPDatabase
+from .async_xp_database import AsyncXPDatabase, BACKENDS
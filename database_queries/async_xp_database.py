@@ -0,0 +1,119 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .memory_xp_database import MemoryXPDatabase
+from .xp_database import XPDatabase
+
+# Storage engines by name, all implementing XPStorage
+BACKENDS = {
+    "sqlite": XPDatabase,
+    "memory": MemoryXPDatabase,
+}
+
+
+class AsyncXPDatabase:
+    """Asyncio front-end for the storage engines, XPDatabase by default.
+
+    Every call to an engine blocking on disk I/O is queued to a single
+    dedicated worker thread that owns the SQLite connection, so handlers
+    can await results while the event loop keeps serving updates. The
+    calls of the other engines run right away on the event loop.
+
+    When given a `metrics` registry, the time each call spends on the
+    worker is observed per method, along with the failed calls.
+    """
+
+    def __init__(self, db_name="./xp_data.db", metrics=None, backend="sqlite",
+                 **options):
+        self.db_name = db_name
+        self.metrics = metrics
+        storage = BACKENDS[backend]
+        if storage.blocking:
+            # One worker keeps the connection on a single thread and
+            # serializes all statements, exactly like the synchronous
+            # class did.
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="xp-db")
+            self._db = self._executor.submit(
+                storage, db_name, **options).result()
+        else:
+            self._executor = None
+            self._db = storage(db_name, **options)
+        self._flush_task = None
+
+    async def start(self):
+        """Start the background flusher when write-behind is enabled."""
+        if self._db.write_behind and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        # Poll a few times per window so no write outlives it by much
+        period = max(self._db.flush_interval / 4, 0.01)
+        while True:
+            await asyncio.sleep(period)
+            await self._run(self._db.flush_if_due)
+
+    async def _run(self, func, *args, **kwargs):
+        call = functools.partial(func, *args, **kwargs)
+        if self.metrics is not None:
+            call = functools.partial(self._timed, call, func.__name__)
+        if self._executor is None:
+            return call()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, call)
+
+    def _timed(self, call, name):
+        # Runs on the worker, so queueing behind other calls isn't counted
+        start = time.perf_counter()
+        try:
+            return call()
+        except Exception:
+            self.metrics.inc("xp_bot_db_errors_total", method=name)
+            raise
+        finally:
+            self.metrics.observe("xp_bot_db_query_seconds",
+                                 time.perf_counter() - start, method=name)
+
+    async def is_chat_enabled(self, chat_id):
+        """Check if XP tracking is enabled, skipping the worker on cache hits."""
+        settings = self._db.get_cached_chat_settings(chat_id)
+        if settings is not None:
+            return settings[0]
+        return await self._run(self._db.is_chat_enabled, chat_id)
+
+    async def get_chat_cooldown(self, chat_id):
+        """Get the chat cooldown, skipping the worker on cache hits."""
+        settings = self._db.get_cached_chat_settings(chat_id)
+        if settings is not None:
+            return settings[1]
+        return await self._run(self._db.get_chat_cooldown, chat_id)
+
+    def settings_stats(self):
+        """Chat settings cache statistics, safe to read from the event loop."""
+        return self._db.settings_stats()
+
+    def __getattr__(self, name):
+        # Expose every public XPDatabase method as a coroutine
+        if name.startswith("_"):
+            raise AttributeError(name)
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+
+        async def method(*args, **kwargs):
+            return await self._run(attr, *args, **kwargs)
+
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        return method
+
+    async def close(self):
+        """Flush, close the connection and stop the worker thread."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._run(self._db.close)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
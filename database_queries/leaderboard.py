@@ -0,0 +1,136 @@
+import bisect
+
+MEDALS = ("🥇", "🥈", "🥉")
+
+# Entries per sublist of the ranking, a sublist is split at twice as many
+LOAD = 500
+
+
+class Leaderboard:
+    """XP ranking of the users of one chat, kept sorted as XP changes.
+
+    Entries are (-xp, user_id) kept sorted in sublists of at most 2 * LOAD
+    entries, with the last entry of each sublist and a Fenwick tree of
+    their sizes. A change bisects to its sublist and only shifts that
+    sublist, a user's rank adds the sizes of the sublists before theirs,
+    so both are O(log n). Top-N reads the first sublists.
+    """
+
+    def __init__(self, rows=()):
+        self._xp = dict(rows)
+        ranking = sorted((-xp, user_id) for user_id, xp in self._xp.items())
+        self._lists = [ranking[i:i + LOAD]
+                       for i in range(0, len(ranking), LOAD)]
+        self._maxes = [sublist[-1] for sublist in self._lists]
+        self._sizes = None
+
+    def __len__(self):
+        return len(self._xp)
+
+    def __contains__(self, user_id):
+        return user_id in self._xp
+
+    def items(self):
+        """Return the (user_id, xp) of every ranked user, in no order."""
+        return self._xp.items()
+
+    def get(self, user_id):
+        """Return the XP of a user, 0 if they are not ranked."""
+        return self._xp.get(user_id, 0)
+
+    def set(self, user_id, xp):
+        """Insert a user or move them to their new position."""
+        self._discard(user_id)
+        self._xp[user_id] = xp
+        self._insert((-xp, user_id))
+
+    def add(self, user_id, xp_delta):
+        self.set(user_id, self.get(user_id) + xp_delta)
+
+    def remove(self, user_id):
+        self._discard(user_id)
+        self._xp.pop(user_id, None)
+
+    def _insert(self, entry):
+        if not self._lists:
+            self._lists.append([entry])
+            self._maxes.append(entry)
+            self._sizes = None
+            return
+        i = bisect.bisect_left(self._maxes, entry)
+        if i == len(self._maxes):
+            i -= 1
+        sublist = self._lists[i]
+        bisect.insort(sublist, entry)
+        self._maxes[i] = sublist[-1]
+        if len(sublist) > 2 * LOAD:
+            self._lists[i:i + 1] = [sublist[:LOAD], sublist[LOAD:]]
+            self._maxes[i:i + 1] = [sublist[LOAD - 1], sublist[-1]]
+            self._sizes = None
+        else:
+            self._resize(i, 1)
+
+    def _discard(self, user_id):
+        xp = self._xp.get(user_id)
+        if xp is None:
+            return
+        entry = (-xp, user_id)
+        i = bisect.bisect_left(self._maxes, entry)
+        sublist = self._lists[i]
+        del sublist[bisect.bisect_left(sublist, entry)]
+        if sublist:
+            self._maxes[i] = sublist[-1]
+            self._resize(i, -1)
+        else:
+            del self._lists[i], self._maxes[i]
+            self._sizes = None
+
+    def _resize(self, i, delta):
+        # A Fenwick tree rebuilt after splits is only updated in place
+        sizes = self._sizes
+        if sizes is None:
+            return
+        i += 1
+        while i < len(sizes):
+            sizes[i] += delta
+            i += i & -i
+
+    def _count_before(self, i):
+        """Return the number of entries in the sublists before the i-th."""
+        sizes = self._sizes
+        if sizes is None:
+            sizes = self._sizes = [0] + [len(sublist) for sublist in self._lists]
+            for j in range(1, len(sizes)):
+                parent = j + (j & -j)
+                if parent < len(sizes):
+                    sizes[parent] += sizes[j]
+        count = 0
+        while i > 0:
+            count += sizes[i]
+            i -= i & -i
+        return count
+
+    def top(self, limit=10):
+        """Return the [(user_id, xp)] of the `limit` best users."""
+        top = []
+        for sublist in self._lists:
+            if len(top) >= limit:
+                break
+            top.extend((user_id, -neg_xp)
+                       for neg_xp, user_id in sublist[:limit - len(top)])
+        return top
+
+    def rank(self, user_id):
+        """Return the 0-based position of a user, None if not ranked."""
+        xp = self._xp.get(user_id)
+        if xp is None:
+            return None
+        entry = (-xp, user_id)
+        i = bisect.bisect_left(self._maxes, entry)
+        return self._count_before(i) + bisect.bisect_left(self._lists[i], entry)
+
+    def medal(self, user_id):
+        rank = self.rank(user_id)
+        if rank is not None and rank < len(MEDALS):
+            return MEDALS[rank]
+        return ""
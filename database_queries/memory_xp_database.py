@@ -0,0 +1,552 @@
+import heapq
+import json
+import logging
+import os
+import pickle
+import time
+from array import array
+from bisect import bisect_left
+
+from .leaderboard import Leaderboard
+from .storage import XPStorage
+from .xp_database import day_of
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+# Sender of the events without one, Telegram never uses 0 as a user id
+NO_SENDER = 0
+
+
+class _EventLog:
+    """XP history of one chat as columns of machine integers, oldest first.
+
+    Each event has a position that never changes, its index plus the
+    number of events dropped before it, and every user the positions of
+    the events they gave or received.
+    """
+
+    def __init__(self):
+        self.sender = array("q")
+        self.reciever = array("q")
+        self.delta = array("q")
+        self.created = array("d")
+        self.dropped = 0
+        # user_id -> positions of their events
+        self.by_user = {}
+
+    def __len__(self):
+        return len(self.created)
+
+    def __getstate__(self):
+        # The per-user index is rebuilt on load, snapshots stay small
+        return (self.sender, self.reciever, self.delta, self.created,
+                self.dropped)
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.dropped = state[4]
+        for sender_id, *event in zip(*state[:4]):
+            self.append(None if sender_id == NO_SENDER else sender_id, *event)
+
+    def append(self, sender_id, reciever_id, xp_delta, created_at):
+        position = self.dropped + len(self.created)
+        self.sender.append(NO_SENDER if sender_id is None else sender_id)
+        self.reciever.append(reciever_id)
+        self.delta.append(xp_delta)
+        self.created.append(created_at)
+        for user_id in {sender_id, reciever_id} - {None}:
+            positions = self.by_user.get(user_id)
+            if positions is None:
+                positions = self.by_user[user_id] = array("q")
+            positions.append(position)
+
+    def event(self, i):
+        sender = self.sender[i]
+        return (None if sender == NO_SENDER else sender, self.reciever[i],
+                self.delta[i], self.created[i])
+
+    def latest(self, limit, user_id=None):
+        if user_id is None:
+            indexes = range(len(self) - 1, max(-1, len(self) - 1 - limit), -1)
+        else:
+            positions = self.by_user.get(user_id, ())
+            indexes = [position - self.dropped
+                       for position in positions[:-limit - 1:-1]]
+        return [self.event(i) for i in indexes]
+
+    def drop_oldest(self, count):
+        users = set(self.sender[:count]) | set(self.reciever[:count])
+        for column in (self.sender, self.reciever, self.delta, self.created):
+            del column[:count]
+        self.dropped += count
+        for user_id in users:
+            positions = self.by_user.get(user_id)
+            if positions is None:
+                continue
+            del positions[:bisect_left(positions, self.dropped)]
+            if not positions:
+                del self.by_user[user_id]
+
+
+class MemoryXPDatabase(XPStorage):
+    """XP storage held in memory, for small deployments and benchmarks.
+
+    Every mutation is appended to a journal next to the snapshot file
+    before being applied. checkpoint() writes an atomic snapshot of the
+    whole state and empties the journal, and on start the snapshot is
+    loaded and the journal replayed on top of it.
+
+    The journal is written to the OS after every mutation, so only a
+    power loss can lose the last ones, or after `flush_batch` mutations
+    or `flush_interval` seconds in write-behind mode. Calls never wait on
+    the disk except checkpoint(), and run on the calling thread.
+    """
+
+    blocking = False
+    extension = ".snapshot"
+
+    def __init__(self, db_name="./xp_data.snapshot", write_behind=False,
+                 flush_interval=1.0, flush_batch=500):
+        self.db_name = db_name
+        self.journal_name = f"{db_name}.journal"
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._pending_writes = 0
+        self._first_pending = None
+        self._journal_entries = 0
+        self.settings_hits = 0
+
+        # Sequence number of the last mutation, journal entries up to the
+        # one saved in the snapshot are already part of it
+        self._seq = 0
+        # chat_id -> xp_enabled, and cooldown_seconds while enabled
+        self._enabled = {}
+        self._cooldowns = {}
+        # chat_id -> (changes, seconds) of the chats with their own limit
+        self._rate_limits = {}
+        # chat_id -> Leaderboard of the current season
+        self._leaderboards = {}
+        # chat_id -> {day: {user_id: xp}}
+        self._daily = {}
+        # chat_id -> _EventLog
+        self._events = {}
+        # (chat_id, user_id) -> (full_name, updated_at)
+        self._names = {}
+        # chat_id -> (added_by, added_at)
+        self._groups = {}
+        # name -> [text, started_at, finished_at], name -> {chat_id: ok}
+        self._broadcasts = {}
+        self._broadcast_sent = {}
+        # season -> (ended_at, {chat_id: Leaderboard}), oldest first
+        self._seasons = {}
+        # chat_id -> Leaderboard over every season, built when first read
+        self._all_time = {}
+
+        self._load()
+        self._journal = open(self.journal_name, "a", encoding="utf-8")
+
+    # Snapshots and journal
+
+    def _load(self):
+        try:
+            with open(self.db_name, "rb") as file:
+                state = pickle.load(file)
+        except FileNotFoundError:
+            state = None
+        if state is not None:
+            if state["version"] != SNAPSHOT_VERSION:
+                raise RuntimeError(
+                    f"Snapshot version {state['version']} is not supported")
+            self._seq = state["seq"]
+            self._enabled = state["enabled"]
+            self._cooldowns = state["cooldowns"]
+            self._rate_limits = state.get("rate_limits", {})
+            self._leaderboards = {chat_id: Leaderboard(xp.items())
+                                  for chat_id, xp in state["xp"].items()}
+            self._daily = state["daily"]
+            self._events = state["events"]
+            self._names = state["names"]
+            self._groups = state["groups"]
+            self._broadcasts = state["broadcasts"]
+            self._broadcast_sent = state["broadcast_sent"]
+            self._seasons = {
+                season: (ended_at, {chat_id: Leaderboard(xp.items())
+                                    for chat_id, xp in chats.items()})
+                for season, (ended_at, chats) in state["seasons"].items()
+            }
+
+        lines = replayed = 0
+        try:
+            with open(self.journal_name, "r", encoding="utf-8") as file:
+                for line in file:
+                    lines += 1
+                    try:
+                        seq, op, *args = json.loads(line)
+                    except ValueError:
+                        # The last line of a crash may be cut short
+                        logger.warning(f"Ignoring a torn entry of {self.journal_name}")
+                        break
+                    # Already in the snapshot if it crashed before the
+                    # journal was emptied
+                    if seq <= self._seq:
+                        continue
+                    getattr(self, f"_apply_{op}")(*args)
+                    self._seq = seq
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+        if lines:
+            logger.info(f"Replayed {replayed} changes from {self.journal_name}")
+            # Start the next journal clean, without a torn entry in it
+            self._snapshot()
+            open(self.journal_name, "w").close()
+
+    def _snapshot(self):
+        state = {
+            "version": SNAPSHOT_VERSION,
+            "seq": self._seq,
+            "enabled": self._enabled,
+            "cooldowns": self._cooldowns,
+            "rate_limits": self._rate_limits,
+            "xp": {chat_id: dict(leaderboard.items())
+                   for chat_id, leaderboard in self._leaderboards.items()
+                   if len(leaderboard)},
+            "daily": self._daily,
+            "events": self._events,
+            "names": self._names,
+            "groups": self._groups,
+            "broadcasts": self._broadcasts,
+            "broadcast_sent": self._broadcast_sent,
+            "seasons": {
+                season: (ended_at, {chat_id: dict(leaderboard.items())
+                                    for chat_id, leaderboard in chats.items()})
+                for season, (ended_at, chats) in self._seasons.items()
+            },
+        }
+        tmp_name = f"{self.db_name}.tmp"
+        with open(tmp_name, "wb") as file:
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_name, self.db_name)
+
+    def _write(self, op, *args):
+        """Journal a mutation, then apply it."""
+        self._seq += 1
+        self._journal.write(json.dumps([self._seq, op, *args]) + "\n")
+        self._journal_entries += 1
+        if not self.write_behind:
+            self._journal.flush()
+        else:
+            if self._pending_writes == 0:
+                self._first_pending = time.monotonic()
+            self._pending_writes += 1
+            if self._pending_writes >= self.flush_batch:
+                self.flush()
+        return getattr(self, f"_apply_{op}")(*args)
+
+    def flush(self):
+        self._journal.flush()
+        self._pending_writes = 0
+        self._first_pending = None
+
+    def flush_if_due(self):
+        if (
+            self._pending_writes
+            and time.monotonic() - self._first_pending >= self.flush_interval
+        ):
+            self.flush()
+
+    def checkpoint(self):
+        """Snapshot the state and empty the journal."""
+        self.flush()
+        entries = self._journal_entries
+        if not entries:
+            return 0, 0
+        self._snapshot()
+        self._journal.close()
+        self._journal = open(self.journal_name, "w", encoding="utf-8")
+        self._journal_entries = 0
+        return entries, entries
+
+    def close(self):
+        self.checkpoint()
+        self._journal.close()
+
+    # Chat settings
+
+    def get_cached_chat_settings(self, chat_id):
+        self.settings_hits += 1
+        return self.is_chat_enabled(chat_id), self.get_chat_cooldown(chat_id)
+
+    def settings_stats(self):
+        return {"size": len(self._enabled), "hits": self.settings_hits,
+                "misses": 0, "hit_rate": 1.0 if self.settings_hits else 0.0}
+
+    def enable_chat(self, chat_id):
+        return self._write("enable_chat", chat_id)
+
+    def _apply_enable_chat(self, chat_id):
+        self._enabled[chat_id] = True
+        self._cooldowns.setdefault(chat_id, 30)
+        return True
+
+    def disable_chat(self, chat_id):
+        return self._write("disable_chat", chat_id)
+
+    def _apply_disable_chat(self, chat_id):
+        self._enabled[chat_id] = False
+        self._cooldowns.pop(chat_id, None)
+        return True
+
+    def is_chat_enabled(self, chat_id):
+        return self._enabled.get(chat_id, False)
+
+    def set_chat_cooldown(self, chat_id, seconds):
+        return self._write("set_chat_cooldown", chat_id, seconds)
+
+    def _apply_set_chat_cooldown(self, chat_id, seconds):
+        self._cooldowns[chat_id] = seconds
+        return True
+
+    def get_chat_cooldown(self, chat_id):
+        return self._cooldowns.get(chat_id, 30)
+
+    def set_chat_rate_limit(self, chat_id, changes, seconds):
+        return self._write("set_chat_rate_limit", chat_id, changes, seconds)
+
+    def _apply_set_chat_rate_limit(self, chat_id, changes, seconds):
+        if changes is None:
+            self._rate_limits.pop(chat_id, None)
+        else:
+            self._rate_limits[chat_id] = (changes, seconds)
+        return True
+
+    def get_chat_rate_limits(self):
+        return dict(self._rate_limits)
+
+    # XP of the current season
+
+    def _leaderboard(self, chat_id):
+        leaderboard = self._leaderboards.get(chat_id)
+        if leaderboard is None:
+            leaderboard = self._leaderboards[chat_id] = Leaderboard()
+        return leaderboard
+
+    def update_user_xp(self, chat_id, user_id, xp_delta, sender_id=None):
+        self._write("update_user_xp", chat_id, user_id, xp_delta, sender_id,
+                    time.time())
+
+    def _apply_update_user_xp(self, chat_id, user_id, xp_delta, sender_id, now):
+        self._leaderboard(chat_id).add(user_id, xp_delta)
+        day = self._daily.setdefault(chat_id, {}).setdefault(day_of(now), {})
+        day[user_id] = day.get(user_id, 0) + xp_delta
+        events = self._events.get(chat_id)
+        if events is None:
+            events = self._events[chat_id] = _EventLog()
+        events.append(sender_id, user_id, xp_delta, now)
+        if chat_id in self._all_time:
+            self._all_time[chat_id].add(user_id, xp_delta)
+
+    def get_user_xp(self, chat_id, user_id):
+        return self._leaderboard(chat_id).get(user_id)
+
+    def get_top_users(self, chat_id, limit=10):
+        return self._leaderboard(chat_id).top(limit)
+
+    def get_rank(self, chat_id, user_id):
+        return self._leaderboard(chat_id).rank(user_id)
+
+    def get_medal(self, chat_id, user_id):
+        return self._leaderboard(chat_id).medal(user_id)
+
+    def remove_user(self, user_id, chat_id):
+        self._write("remove_user", user_id, chat_id)
+
+    def _apply_remove_user(self, user_id, chat_id):
+        if chat_id in self._leaderboards:
+            self._leaderboards[chat_id].remove(user_id)
+        for day in self._daily.get(chat_id, {}).values():
+            day.pop(user_id, None)
+        self._all_time.pop(chat_id, None)
+
+    def get_window_top_users(self, chat_id, days, limit=10):
+        daily = self._daily.get(chat_id, {})
+        today = day_of(time.time())
+        totals = {}
+        for day in range(today - days + 1, today + 1):
+            for user_id, xp in daily.get(day, {}).items():
+                totals[user_id] = totals.get(user_id, 0) + xp
+        return heapq.nlargest(limit, totals.items(), key=lambda item: item[1])
+
+    def get_xp_events(self, chat_id, user_id=None, limit=50):
+        events = self._events.get(chat_id)
+        if events is None:
+            return []
+        return events.latest(limit, user_id)
+
+    def compact_xp_events(self, before, limit=5000):
+        return self._write("compact_xp_events", before, limit)
+
+    def _apply_compact_xp_events(self, before, limit):
+        deleted = 0
+        for chat_id, events in list(self._events.items()):
+            if deleted == limit:
+                break
+            # Events are appended in time order
+            count = min(bisect_left(events.created, before), limit - deleted)
+            events.drop_oldest(count)
+            deleted += count
+            if not len(events):
+                del self._events[chat_id]
+        return deleted
+
+    def compact_xp_daily(self, before_day, limit=5000):
+        return self._write("compact_xp_daily", before_day, limit)
+
+    def _apply_compact_xp_daily(self, before_day, limit):
+        deleted = 0
+        for chat_id, daily in list(self._daily.items()):
+            for day in sorted(day for day in daily if day < before_day):
+                users = daily[day]
+                while users and deleted < limit:
+                    users.popitem()
+                    deleted += 1
+                if users:
+                    return deleted
+                del daily[day]
+            if not daily:
+                del self._daily[chat_id]
+        return deleted
+
+    # Names
+
+    def update_username(self, chat_id, user_id, full_name):
+        self._write("set_username", chat_id, user_id, full_name, time.time())
+
+    def refresh_username(self, chat_id, user_id, full_name):
+        self._write("set_username", chat_id, user_id, full_name, time.time())
+
+    def _apply_set_username(self, chat_id, user_id, full_name, now):
+        self._names[chat_id, user_id] = (full_name, now)
+
+    def get_stored_username_by_user_id(self, chat_id, user_id):
+        entry = self._names.get((chat_id, user_id))
+        return None if entry is None else entry[0]
+
+    def get_stored_usernames(self, chat_id, user_ids):
+        results = {}
+        for user_id in user_ids:
+            entry = self._names.get((chat_id, user_id))
+            if entry is not None:
+                results[user_id] = entry
+        return results
+
+    # Groups and broadcasts
+
+    def register_group(self, chat_id, added_by=None):
+        self._write("register_group", chat_id, added_by, time.time())
+
+    def _apply_register_group(self, chat_id, added_by, now):
+        previous = self._groups.get(chat_id)
+        if previous is None:
+            self._groups[chat_id] = (added_by, now)
+        elif added_by is not None:
+            self._groups[chat_id] = (added_by, previous[1])
+
+    def remove_group(self, chat_id):
+        self._write("remove_group", chat_id)
+
+    def _apply_remove_group(self, chat_id):
+        self._groups.pop(chat_id, None)
+
+    def get_groups(self):
+        return list(self._groups)
+
+    def get_bot_added_by(self, chat_id):
+        entry = self._groups.get(chat_id)
+        return None if entry is None else entry[0]
+
+    def start_broadcast(self, name, text):
+        self._write("start_broadcast", name, text, time.time())
+
+    def _apply_start_broadcast(self, name, text, now):
+        self._broadcasts.setdefault(name, [text, now, None])
+
+    def get_broadcast(self, name):
+        broadcast = self._broadcasts.get(name)
+        return None if broadcast is None else (broadcast[0], broadcast[2])
+
+    def get_unfinished_broadcasts(self):
+        unfinished = [(started_at, name) for name, (_, started_at, finished_at)
+                      in self._broadcasts.items() if finished_at is None]
+        return [name for _, name in sorted(unfinished)]
+
+    def get_broadcast_pending(self, name, limit=500):
+        sent = self._broadcast_sent.get(name, {})
+        pending = (chat_id for chat_id in self._groups if chat_id not in sent)
+        return heapq.nsmallest(limit, pending)
+
+    def mark_broadcast_sent(self, name, chat_id, ok=True):
+        self._write("mark_broadcast_sent", name, chat_id, ok)
+
+    def _apply_mark_broadcast_sent(self, name, chat_id, ok):
+        self._broadcast_sent.setdefault(name, {})[chat_id] = ok
+
+    def finish_broadcast(self, name):
+        self._write("finish_broadcast", name, time.time())
+
+    def _apply_finish_broadcast(self, name, now):
+        if name in self._broadcasts:
+            self._broadcasts[name][2] = now
+        self._broadcast_sent.pop(name, None)
+
+    # Seasons
+
+    def start_new_season(self, season):
+        if season in self._seasons:
+            raise ValueError(f"Season {season} already exists")
+        self._write("start_new_season", season, time.time())
+
+    def _apply_start_new_season(self, season, now):
+        # The leaderboards are kept as they are, only new ones get updates
+        self._seasons[season] = (now, {
+            chat_id: leaderboard
+            for chat_id, leaderboard in self._leaderboards.items()
+            if len(leaderboard)
+        })
+        self._leaderboards = {}
+
+    def get_seasons(self):
+        return sorted(((season, ended_at) for season, (ended_at, _)
+                       in self._seasons.items()), key=lambda item: item[1])
+
+    def _season(self, season, chat_id):
+        if season not in self._seasons:
+            raise ValueError(f"Unknown season {season}")
+        return self._seasons[season][1].get(chat_id) or Leaderboard()
+
+    def get_season_top_users(self, season, chat_id, limit=10):
+        return self._season(season, chat_id).top(limit)
+
+    def get_season_user_xp(self, season, chat_id, user_id):
+        return self._season(season, chat_id).get(user_id)
+
+    def _all_time_leaderboard(self, chat_id):
+        leaderboard = self._all_time.get(chat_id)
+        if leaderboard is None:
+            totals = dict(self._leaderboard(chat_id).items())
+            for _, chats in self._seasons.values():
+                for user_id, xp in chats.get(chat_id, Leaderboard()).items():
+                    totals[user_id] = totals.get(user_id, 0) + xp
+            leaderboard = self._all_time[chat_id] = Leaderboard(totals.items())
+        return leaderboard
+
+    def get_all_time_top_users(self, chat_id, limit=10):
+        return self._all_time_leaderboard(chat_id).top(limit)
+
+    def get_all_time_user_xp(self, chat_id, user_id):
+        return self._all_time_leaderboard(chat_id).get(user_id)
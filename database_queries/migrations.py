@@ -0,0 +1,332 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# PRAGMAs applied on every connection. "default" keeps every commit durable,
+# "fast" trades the last commits before a power loss for throughput and
+# "small" keeps the memory use low on tiny hosts.
+PRAGMA_PROFILES = {
+    "default": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "cache_size": -16000,
+        "mmap_size": 64 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    "small": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -2000,
+        "mmap_size": 0,
+        "temp_store": "FILE",
+        "busy_timeout": 5000,
+    },
+}
+
+
+def apply_pragmas(conn, profile="default"):
+    """Configure a connection with one of the PRAGMA_PROFILES."""
+    if profile not in PRAGMA_PROFILES:
+        raise ValueError(f"Unknown PRAGMA profile {profile}")
+    for name, value in PRAGMA_PROFILES[profile].items():
+        conn.execute(f"PRAGMA {name}={value}")
+
+
+def top_index(table_name):
+    """Name of the covering (chat_id, xp, user_id) index of a user_xp table."""
+    return f"idx_{table_name}_top"
+
+
+def create_user_xp_table(cursor, archive_name):
+    """Create the live user_xp table.
+
+    Its index is named after `archive_name`, the table it becomes at the
+    next season rollover, since an index keeps its name when its table is
+    renamed.
+    """
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_xp (
+            chat_id INTEGER,
+            user_id INTEGER,
+            xp INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id),
+            FOREIGN KEY (chat_id) REFERENCES chat_settings(chat_id)
+        );
+        """
+    )
+    cursor.execute(
+        f"""
+        CREATE INDEX IF NOT EXISTS {top_index(archive_name)}
+        ON user_xp (chat_id, xp DESC, user_id);
+        """
+    )
+
+
+def next_archive_name(cursor):
+    """Name the live user_xp table gets when its season is archived."""
+    cursor.execute("SELECT COUNT(*) FROM seasons")
+    return f"user_xp_{cursor.fetchone()[0] + 1}"
+
+
+def create_season_table(cursor, season, ended_at):
+    """Register an empty archived season and return its table name.
+
+    Used to import seasons, the live user_xp index moves on to the name
+    of the following archive table.
+    """
+    table_name = next_archive_name(cursor)
+    cursor.execute(f"DROP INDEX IF EXISTS {top_index(table_name)}")
+    cursor.execute(
+        f"""
+        CREATE TABLE {table_name} (
+            chat_id INTEGER,
+            user_id INTEGER,
+            xp INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id)
+        );
+        """
+    )
+    cursor.execute(
+        f"""
+        CREATE INDEX {top_index(table_name)}
+        ON {table_name} (chat_id, xp DESC, user_id);
+        """
+    )
+    cursor.execute(
+        "INSERT INTO seasons (season, table_name, ended_at) VALUES (?, ?, ?)",
+        (season, table_name, ended_at),
+    )
+    create_user_xp_table(cursor, next_archive_name(cursor))
+    return table_name
+
+
+def _baseline(cursor):
+    """Schema of the databases created before versioning."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id INTEGER PRIMARY KEY,
+            xp_enabled INTEGER NOT NULL DEFAULT 0
+        );
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_xp (
+            chat_id INTEGER,
+            user_id INTEGER,
+            xp INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id),
+            FOREIGN KEY (chat_id) REFERENCES chat_settings(chat_id)
+        );
+        """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_user_xp_chat_xp
+        ON user_xp (chat_id, xp DESC);
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS username (
+            chat_id INTEGER,
+            user_id INTEGER,
+            full_name TEXT,
+            PRIMARY KEY (chat_id, user_id),
+            FOREIGN KEY (chat_id) REFERENCES chat_settings(chat_id)
+        );
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_cooldown (
+            chat_id INTEGER PRIMARY KEY,
+            cooldown_seconds INTEGER NOT NULL DEFAULT 30,
+            FOREIGN KEY (chat_id) REFERENCES chat_settings(chat_id)
+        );
+        """
+    )
+    # Databases created before names were timestamped lack updated_at
+    cursor.execute("PRAGMA table_info(username)")
+    if "updated_at" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE username ADD COLUMN updated_at REAL")
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS xp_events (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            sender_id INTEGER,
+            reciever_id INTEGER NOT NULL,
+            xp_delta INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        );
+        """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_xp_events_chat
+        ON xp_events (chat_id, created_at);
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS xp_daily (
+            chat_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            xp INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, day, user_id)
+        );
+        """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_xp_daily_day ON xp_daily (day);"
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS seasons (
+            season TEXT PRIMARY KEY,
+            table_name TEXT NOT NULL,
+            ended_at REAL NOT NULL
+        );
+        """
+    )
+
+
+def _add_groups(cursor):
+    """Groups the bot was added to, and by whom."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS groups (
+            chat_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            added_at REAL
+        );
+        """
+    )
+
+
+def _add_covering_indexes(cursor):
+    """Indexes answering the leaderboards and the per-user history alone."""
+    # Leaderboards of the live and archived seasons read only the index
+    cursor.execute("DROP INDEX IF EXISTS idx_user_xp_chat_xp")
+    create_user_xp_table(cursor, next_archive_name(cursor))
+    cursor.execute("SELECT table_name FROM seasons")
+    for (table_name,) in cursor.fetchall():
+        cursor.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS {top_index(table_name)}
+            ON {table_name} (chat_id, xp DESC, user_id);
+            """
+        )
+    # A user's history is what they received or gave
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_xp_events_reciever
+        ON xp_events (chat_id, reciever_id, created_at);
+        """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_xp_events_sender
+        ON xp_events (chat_id, sender_id, created_at);
+        """
+    )
+
+
+def _add_broadcasts(cursor):
+    """Broadcasts to every group, with the groups already done."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            name TEXT PRIMARY KEY,
+            text TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            finished_at REAL
+        );
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_sent (
+            name TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            ok INTEGER NOT NULL,
+            PRIMARY KEY (name, chat_id)
+        ) WITHOUT ROWID;
+        """
+    )
+
+
+def _add_rate_limits(cursor):
+    """Per-chat limits of the XP changes of each sender."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_rate_limit (
+            chat_id INTEGER PRIMARY KEY,
+            changes INTEGER NOT NULL,
+            seconds INTEGER NOT NULL
+        );
+        """
+    )
+
+
+def _add_imported_archives(cursor):
+    """Yearly archive files already imported, left out of the all-time totals."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS imported_archives (
+            file TEXT PRIMARY KEY,
+            imported_at REAL NOT NULL
+        );
+        """
+    )
+
+
+# Applied in order, the schema version of a database is the number of
+# migrations it went through. Only ever append to this list.
+MIGRATIONS = [
+    _baseline,
+    _add_groups,
+    _add_covering_indexes,
+    _add_broadcasts,
+    _add_rate_limits,
+    _add_imported_archives,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(conn):
+    """Bring a database up to SCHEMA_VERSION, one transaction per migration."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database schema version {version} is newer than this bot "
+            f"({SCHEMA_VERSION})"
+        )
+
+    for number in range(version + 1, SCHEMA_VERSION + 1):
+        migration = MIGRATIONS[number - 1]
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        try:
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version={number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        logger.info(f"Migrated database to version {number}: {migration.__doc__}")
@@ -0,0 +1,220 @@
+from abc import ABC, abstractmethod
+
+
+class XPStorage(ABC):
+    """Interface of the XP storage engines.
+
+    Engines are used from a single thread, AsyncXPDatabase moves the ones
+    whose calls block on disk I/O to a worker thread. Mutations may be
+    buffered until flush(), as long as the reads of the same engine see
+    them right away. Engines must implement every abstract method, the
+    others have a default for engines without such maintenance.
+    """
+
+    # Whether calls block on disk I/O, and so need a worker thread
+    blocking = True
+    # Extension of the default file name
+    extension = ""
+
+    write_behind = False
+    flush_interval = 1.0
+
+    # Durability and maintenance
+
+    def flush(self):
+        """Make every buffered mutation durable."""
+
+    def flush_if_due(self):
+        """Flush once the oldest buffered mutation reaches the flush interval."""
+
+    def checkpoint(self):
+        """Fold the log of recent changes into the main file and return
+        (entries in the log, entries folded)."""
+        return 0, 0
+
+    def optimize(self):
+        """Refresh whatever helps the engine answer queries quickly."""
+
+    def incremental_vacuum(self, pages=256):
+        """Give up to `pages` unused pages back and return how many are left."""
+        return 0
+
+    @abstractmethod
+    def close(self):
+        """Flush and release the files."""
+
+    # Chat settings
+
+    def get_cached_chat_settings(self, chat_id):
+        """Return (xp_enabled, cooldown_seconds) if known without I/O, else None.
+
+        Safe to call from another thread than the engine's.
+        """
+        return None
+
+    def settings_stats(self):
+        """Return the "size", "hits", "misses" and "hit_rate" of the settings cache."""
+        return {"size": 0, "hits": 0, "misses": 0, "hit_rate": 0.0}
+
+    @abstractmethod
+    def enable_chat(self, chat_id):
+        """Enable XP tracking in a chat, return whether it succeeded."""
+
+    @abstractmethod
+    def disable_chat(self, chat_id):
+        """Disable XP tracking in a chat, return whether it succeeded."""
+
+    @abstractmethod
+    def is_chat_enabled(self, chat_id):
+        """Whether XP is tracked in a chat."""
+
+    @abstractmethod
+    def set_chat_cooldown(self, chat_id, seconds):
+        """Set the XP cooldown of a chat, return whether it succeeded."""
+
+    @abstractmethod
+    def get_chat_cooldown(self, chat_id):
+        """Get the XP cooldown of a chat, 30 seconds when never set."""
+
+    @abstractmethod
+    def set_chat_rate_limit(self, chat_id, changes, seconds):
+        """Let each sender of a chat change XP `changes` times per `seconds`
+        seconds, None for the default limit. Return whether it succeeded."""
+
+    @abstractmethod
+    def get_chat_rate_limits(self):
+        """Get the {chat_id: (changes, seconds)} of the chats with their own limit."""
+
+    # XP of the current season
+
+    @abstractmethod
+    def update_user_xp(self, chat_id, user_id, xp_delta, sender_id=None):
+        """Add `xp_delta` to a user's XP and record the change in the history."""
+
+    @abstractmethod
+    def get_user_xp(self, chat_id, user_id):
+        """Get a user's current XP, 0 if they have none."""
+
+    @abstractmethod
+    def get_top_users(self, chat_id, limit=10):
+        """Get the [(user_id, xp)] of the best users of a chat."""
+
+    @abstractmethod
+    def get_rank(self, chat_id, user_id):
+        """Get the 0-based position of a user in the chat, None if unranked."""
+
+    @abstractmethod
+    def get_medal(self, chat_id, user_id):
+        """Get the medal of a user among the first three, "" otherwise."""
+
+    @abstractmethod
+    def remove_user(self, user_id, chat_id):
+        """Forget a user's XP of the current season in a chat."""
+
+    @abstractmethod
+    def get_window_top_users(self, chat_id, days, limit=10):
+        """Get the [(user_id, xp)] of the users who earned the most XP over
+        the last `days` days, today included."""
+
+    @abstractmethod
+    def get_xp_events(self, chat_id, user_id=None, limit=50):
+        """Get the latest [(sender_id, reciever_id, xp_delta, created_at)] of
+        a chat, or only those given or received by `user_id`."""
+
+    @abstractmethod
+    def compact_xp_events(self, before, limit=5000):
+        """Delete up to `limit` history events older than the `before`
+        timestamp and return how many were deleted."""
+
+    @abstractmethod
+    def compact_xp_daily(self, before_day, limit=5000):
+        """Delete up to `limit` daily totals older than `before_day` and
+        return how many were deleted."""
+
+    # Names
+
+    @abstractmethod
+    def update_username(self, chat_id, user_id, full_name):
+        """Store the full name of a user, stamped with the current time."""
+
+    @abstractmethod
+    def refresh_username(self, chat_id, user_id, full_name):
+        """Store the last known full name of a user, after a change of XP."""
+
+    @abstractmethod
+    def get_stored_username_by_user_id(self, chat_id, user_id):
+        """Get the stored full name of a user, None if unknown."""
+
+    @abstractmethod
+    def get_stored_usernames(self, chat_id, user_ids):
+        """Get {user_id: (full_name, updated_at)} for the stored users of a chat."""
+
+    # Groups and broadcasts
+
+    @abstractmethod
+    def register_group(self, chat_id, added_by=None):
+        """Remember a group the bot is in, and who added the bot when known."""
+
+    @abstractmethod
+    def remove_group(self, chat_id):
+        """Forget a group the bot left."""
+
+    @abstractmethod
+    def get_groups(self):
+        """Get the ids of every group the bot is in."""
+
+    @abstractmethod
+    def get_bot_added_by(self, chat_id):
+        """Get the id of the user who added the bot to a group, None if unknown."""
+
+    @abstractmethod
+    def start_broadcast(self, name, text):
+        """Record a broadcast to every group, unless it was already started."""
+
+    @abstractmethod
+    def get_broadcast(self, name):
+        """Get the (text, finished_at) of a broadcast, None if unknown."""
+
+    @abstractmethod
+    def get_unfinished_broadcasts(self):
+        """Get the names of the broadcasts not finished yet, oldest first."""
+
+    @abstractmethod
+    def get_broadcast_pending(self, name, limit=500):
+        """Get up to `limit` groups a broadcast still has to go to."""
+
+    @abstractmethod
+    def mark_broadcast_sent(self, name, chat_id, ok=True):
+        """Checkpoint a group a broadcast is done with, sent or failed."""
+
+    @abstractmethod
+    def finish_broadcast(self, name):
+        """Mark a broadcast as done and drop its per-group checkpoints."""
+
+    # Seasons
+
+    @abstractmethod
+    def start_new_season(self, season):
+        """Archive the current XP as `season` and start again from zero,
+        raising ValueError if the season already exists."""
+
+    @abstractmethod
+    def get_seasons(self):
+        """Get the [(season, ended_at)] of the archived seasons, oldest first."""
+
+    @abstractmethod
+    def get_season_top_users(self, season, chat_id, limit=10):
+        """Get the [(user_id, xp)] of the best users of an archived season,
+        raising ValueError for an unknown season."""
+
+    @abstractmethod
+    def get_season_user_xp(self, season, chat_id, user_id):
+        """Get a user's XP at the end of an archived season, 0 if none."""
+
+    @abstractmethod
+    def get_all_time_top_users(self, chat_id, limit=10):
+        """Get the [(user_id, xp)] of the best users over every season."""
+
+    @abstractmethod
+    def get_all_time_user_xp(self, chat_id, user_id):
+        """Get a user's XP over every season."""
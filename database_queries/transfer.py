@@ -0,0 +1,366 @@
+import argparse
+import csv
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+from pytz import timezone
+
+from .migrations import create_season_table
+from .xp_database import XPDatabase
+
+# Exported tables: (columns, primary key). Archived seasons are exported
+# as "season_xp" rows carrying their season, after a "seasons" row.
+TABLES = {
+    "chat_settings": (("chat_id", "xp_enabled"), ("chat_id",)),
+    "chat_cooldown": (("chat_id", "cooldown_seconds"), ("chat_id",)),
+    "chat_rate_limit": (("chat_id", "changes", "seconds"), ("chat_id",)),
+    "groups": (("chat_id", "user_id", "added_at"), ("chat_id",)),
+    "imported_archives": (("file", "imported_at"), ("file",)),
+    "user_xp": (("chat_id", "user_id", "xp"), ("chat_id", "user_id")),
+    "username": (("chat_id", "user_id", "full_name", "updated_at"),
+                 ("chat_id", "user_id")),
+}
+SEASON_COLUMNS = ("chat_id", "user_id", "xp")
+
+# Rows per executemany, and so the most rows held in memory per table
+BATCH = 10000
+
+# Types of the CSV columns, everything else is text
+INTEGER_COLUMNS = {"chat_id", "user_id", "xp", "xp_enabled", "cooldown_seconds",
+                   "changes", "seconds"}
+REAL_COLUMNS = {"added_at", "updated_at", "ended_at", "imported_at"}
+
+# Yearly files were named after the year whose first day they were moved on
+YEARLY_FILE = re.compile(r"xp_data_(\d{4})\.db$")
+# Timezone of the new year rollover
+ROLLOVER_TIMEZONE = timezone("Europe/Paris")
+
+
+def _connect_readonly(db_name):
+    # Exporting must not migrate or otherwise touch the source database
+    return sqlite3.connect(f"file:{db_name}?mode=ro", uri=True)
+
+
+def _existing_columns(conn, table, columns):
+    """SELECT list of `columns`, NULL for those an older schema lacks."""
+    present = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if not present:
+        return None
+    return ", ".join(c if c in present else f"NULL AS {c}" for c in columns)
+
+
+def iter_rows(db_name, tables=None):
+    """Yield every exported row of a database as a dict with its "table"."""
+    conn = _connect_readonly(db_name)
+    try:
+        for table, (columns, _) in TABLES.items():
+            if tables and table not in tables:
+                continue
+            select = _existing_columns(conn, table, columns)
+            if select is None:
+                continue
+            # Iterating the cursor streams the rows, whatever the table size
+            for row in conn.execute(f"SELECT {select} FROM {table}"):
+                yield {"table": table, **dict(zip(columns, row))}
+
+        if tables and "season_xp" not in tables:
+            return
+        if _existing_columns(conn, "seasons", ("season",)) is None:
+            return
+        seasons = conn.execute(
+            "SELECT season, table_name, ended_at FROM seasons ORDER BY ended_at"
+        ).fetchall()
+        for season, table_name, ended_at in seasons:
+            yield {"table": "seasons", "season": season, "ended_at": ended_at}
+            for row in conn.execute(
+                    f"SELECT chat_id, user_id, xp FROM {table_name}"):
+                yield {"table": "season_xp", "season": season,
+                       **dict(zip(SEASON_COLUMNS, row))}
+    finally:
+        conn.close()
+
+
+def write_jsonl(rows, file):
+    count = 0
+    for row in rows:
+        file.write(json.dumps(row, ensure_ascii=False))
+        file.write("\n")
+        count += 1
+    return count
+
+
+def write_csv(rows, file, table):
+    """Write the rows of a single table, CSV having one set of columns."""
+    columns = SEASON_COLUMNS if table == "season_xp" else TABLES[table][0]
+    if table == "season_xp":
+        columns = ("season", *columns)
+    writer = csv.DictWriter(file, fieldnames=columns, extrasaction="ignore")
+    writer.writeheader()
+    count = 0
+    for row in rows:
+        if row["table"] == table:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def read_jsonl(file):
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def read_csv(file, table):
+    for row in csv.DictReader(file):
+        for column, value in row.items():
+            if value == "":
+                row[column] = None
+            elif column in INTEGER_COLUMNS:
+                row[column] = int(value)
+            elif column in REAL_COLUMNS:
+                row[column] = float(value)
+        row["table"] = table
+        yield row
+
+
+def _upsert(table, columns, key, add_xp):
+    updates = ", ".join(
+        f"{c}={c}+excluded.{c}" if add_xp and c == "xp" else f"{c}=excluded.{c}"
+        for c in columns if c not in key
+    )
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' * len(columns))}) "
+        f"ON CONFLICT({', '.join(key)}) DO UPDATE SET {updates}"
+    )
+
+
+def import_rows(db, rows, add_xp=False, as_season=None, source=None,
+                ended_at=None):
+    """Upsert exported rows into an XPDatabase, in a single transaction.
+
+    With `add_xp`, XP is added to the existing totals instead of replacing
+    them, to merge databases. With `as_season`, user_xp rows go to that
+    archived season instead, to bring in an old xp_data_YYYY.db file,
+    ending at `ended_at` if it doesn't exist yet. The name of a `source`
+    database file is recorded, so that the all-time totals don't also
+    count it as a yearly archive.
+    """
+    cursor = db.conn.cursor()
+    season_tables = dict(
+        cursor.execute("SELECT season, table_name FROM seasons").fetchall())
+    batches = {}
+    count = 0
+
+    def season_table(season, season_end=None):
+        if season not in season_tables:
+            if season_end is None and season == as_season:
+                season_end = ended_at
+            season_tables[season] = create_season_table(
+                cursor, season, time.time() if season_end is None else season_end)
+        return season_tables[season]
+
+    def flush(statement):
+        cursor.executemany(statement, batches.pop(statement))
+
+    # table -> (statement, columns), built once per table
+    plans = {}
+
+    def plan(table, season=None):
+        key = table if season is None else (table, season)
+        if key not in plans:
+            if season is not None:
+                plans[key] = (_upsert(season_table(season), SEASON_COLUMNS,
+                                      ("chat_id", "user_id"), add_xp),
+                              SEASON_COLUMNS)
+            elif table in TABLES:
+                columns, primary_key = TABLES[table]
+                plans[key] = (_upsert(table, columns, primary_key, add_xp),
+                              columns)
+            else:
+                raise ValueError(f"Unknown table {table}")
+        return plans[key]
+
+    cursor.execute("BEGIN")
+    try:
+        for row in rows:
+            table = row["table"]
+            if table == "user_xp" and as_season is not None:
+                table = "season_xp"
+                row["season"] = as_season
+
+            if table == "seasons":
+                season_table(row["season"], row.get("ended_at"))
+                continue
+            statement, columns = plan(
+                table, row["season"] if table == "season_xp" else None)
+            values = tuple(map(row.get, columns))
+
+            batch = batches.setdefault(statement, [])
+            batch.append(values)
+            count += 1
+            if len(batch) >= BATCH:
+                flush(statement)
+        for statement in list(batches):
+            flush(statement)
+        if source is not None:
+            cursor.execute(
+                "INSERT OR REPLACE INTO imported_archives (file, imported_at) "
+                "VALUES (?, ?)",
+                (os.path.basename(source), time.time()),
+            )
+        db.conn.commit()
+    except BaseException:
+        db.conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return count
+
+
+def _open(path, mode):
+    if path == "-":
+        return sys.stdout if "w" in mode else sys.stdin
+    return open(path, mode, newline="" if path.endswith(".csv") else None,
+                encoding="utf-8")
+
+
+def _new_year(year):
+    """Timestamp of the rollover starting a year."""
+    return ROLLOVER_TIMEZONE.localize(datetime(year, 1, 1)).timestamp()
+
+
+def _timestamp(value):
+    """Parse an ISO date or datetime, in the rollover timezone if naive."""
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not an ISO date: {value}")
+    if moment.tzinfo is None:
+        moment = ROLLOVER_TIMEZONE.localize(moment)
+    return moment.timestamp()
+
+
+def _season_end(args):
+    """When the season imported with --as-season ended, None if unknown.
+
+    A yearly file was moved on the first day of the year in its name, and
+    a season named after a year ended on the first day of the next one.
+    """
+    if args.ended_at is not None:
+        return args.ended_at
+    match = YEARLY_FILE.search(args.file)
+    if match:
+        return _new_year(int(match.group(1)))
+    if re.fullmatch(r"\d{4}", args.as_season):
+        return _new_year(int(args.as_season) + 1)
+    return None
+
+
+def _format(args):
+    if args.format is not None:
+        return args.format
+    if args.file.endswith(".db"):
+        return "sqlite"
+    return "csv" if args.file.endswith(".csv") else "jsonl"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="xp-bot-data",
+        description="Export or import the XP, names and settings of a database. "
+                    "Run it while the bot is stopped.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="stream a database to a file")
+    export.add_argument("database")
+    export.add_argument("file", help="output file, - for stdout")
+
+    load = commands.add_parser("import", help="load a file into a database")
+    load.add_argument("database")
+    load.add_argument("file", help="input file, - for stdin, or another "
+                                   "database like an old xp_data_YYYY.db")
+    load.add_argument("--add", action="store_true",
+                      help="add XP to the existing totals instead of replacing them")
+    load.add_argument("--as-season",
+                      help="import the current XP as this archived season")
+    load.add_argument("--ended-at", type=_timestamp,
+                      help="ISO date the --as-season season ended, by default "
+                           "from the xp_data_YYYY.db name or a year as season")
+
+    for command in (export, load):
+        command.add_argument("--format", choices=["jsonl", "csv", "sqlite"],
+                             help="default from the file extension, else jsonl")
+        command.add_argument("--table", choices=[*TABLES, "season_xp"],
+                             help="single table of a CSV file, or the only "
+                                  "table exported to JSONL")
+    args = parser.parse_args(argv)
+
+    fmt = _format(args)
+    if fmt == "csv" and args.table is None:
+        parser.error("CSV files hold a single table, pass --table")
+    if fmt == "sqlite" and args.command == "export":
+        parser.error("Copy the database file to export it as a database")
+    ended_at = None
+    if args.command == "import" and args.as_season is not None:
+        # The import time would sort an old season as the latest one
+        ended_at = _season_end(args)
+        if ended_at is None:
+            parser.error(f"Can't tell when season {args.as_season} ended, "
+                         "pass --ended-at")
+
+    started = time.perf_counter()
+    if args.command == "export":
+        rows = iter_rows(args.database, {args.table} if args.table else None)
+        file = _open(args.file, "w")
+        try:
+            if fmt == "csv":
+                count = write_csv(rows, file, args.table)
+            else:
+                count = write_jsonl(rows, file)
+        finally:
+            if file is not sys.stdout:
+                file.close()
+        action = "Exported"
+    elif fmt == "sqlite":
+        # Straight from another database, which is then known as imported.
+        # An old yearly file only brings its XP into the season, its stale
+        # settings and names would overwrite the current ones.
+        tables = {args.table} if args.table else None
+        if tables is None and args.as_season is not None:
+            tables = {"user_xp"}
+        rows = iter_rows(args.file, tables)
+        db = XPDatabase(args.database, pragma_profile="fast")
+        try:
+            count = import_rows(db, rows, add_xp=args.add,
+                                as_season=args.as_season, source=args.file,
+                                ended_at=ended_at)
+        finally:
+            db.close()
+        action = "Imported"
+    else:
+        file = _open(args.file, "r")
+        # A bigger page cache speeds up the index updates of a bulk load
+        db = XPDatabase(args.database, pragma_profile="fast")
+        try:
+            rows = read_csv(file, args.table) if fmt == "csv" else read_jsonl(file)
+            count = import_rows(db, rows, add_xp=args.add,
+                                as_season=args.as_season, ended_at=ended_at)
+        finally:
+            db.close()
+            if file is not sys.stdin:
+                file.close()
+        action = "Imported"
+
+    print(f"{action} {count} rows in {time.perf_counter() - started:.1f}s",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
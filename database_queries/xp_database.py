@@ -2,60 +2,221 @@ import sqlite3
 from telegram import Update, User
 from typing import Optional
 import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
 
+from .leaderboard import Leaderboard
+from .storage import XPStorage
+from .migrations import (
+    apply_pragmas,
+    create_user_xp_table,
+    migrate,
+    next_archive_name,
+)
 
-class XPDatabase:
+
+logger = logging.getLogger(__name__)
+
+# Yearly files left by the rollovers before seasons lived in the database
+ARCHIVE_FILE = re.compile(r"xp_data_\d+\.db$")
+
+# SQLite attaches at most 10 databases to a connection by default
+MAX_ATTACHED = 8
+
+
+def day_of(timestamp):
+    """Number of the UTC day of a timestamp, the unit of the xp_daily rollup."""
+    return int(timestamp // 86400)
+
+
+class XPDatabase(XPStorage):
     """SQLite database for storing XP data."""
 
-    def __init__(self, db_name="./xp_data.db"):
+    extension = ".db"
+
+    def __init__(self, db_name="./xp_data.db", write_behind=False,
+                 flush_interval=1.0, flush_batch=500,
+                 settings_cache_size=10000, pragma_profile="default",
+                 archive_dir=None):
         self.db_name = db_name
-        self.conn = sqlite3.connect(self.db_name)
-        self._create_tables()
+        # URIs let the yearly archives be attached read-only
+        self.conn = sqlite3.connect(self.db_name, uri=True)
 
-    def _create_tables(self):
-        """Create the necessary database tables if they don't exist."""
-        cursor = self.conn.cursor()
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS chat_settings (
-                chat_id INTEGER PRIMARY KEY,
-                xp_enabled INTEGER NOT NULL DEFAULT 0
-            );
-        """
-        )
-        cursor.execute(
+        # In write-behind mode XP and username changes are applied to the
+        # open transaction right away, so reads on this connection see
+        # them, but only committed once `flush_batch` writes are pending or
+        # the oldest one is `flush_interval` seconds old.
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._pending_writes = 0
+        self._first_pending = None
+
+        # XP changes waiting to be appended to the xp_events ledger, they
+        # are inserted together right before each commit
+        self._events = []
+
+        # LRU cache of chat_id -> (xp_enabled, cooldown_seconds), filled
+        # lazily and dropped on every settings change. The lock lets
+        # other threads peek at it without going through the connection.
+        self.settings_cache_size = settings_cache_size
+        self._settings = OrderedDict()
+        self._settings_lock = threading.Lock()
+        self.settings_hits = 0
+        self.settings_misses = 0
+
+        # chat_id -> Leaderboard, rebuilt from user_xp the first time a
+        # chat is read after startup and then maintained in place.
+        self._leaderboards = {}
+
+        # chat_id -> Leaderboard of the XP over every season, built from
+        # the archived seasons and xp_data_YYYY.db files, which never
+        # change, and then maintained in place like the live ones.
+        self.archive_dir = archive_dir or os.path.dirname(db_name) or "."
+        self._all_time = {}
+        self._archive_files = None
+        # path -> schema alias, least recently used first
+        self._attached = OrderedDict()
+        self._attach_count = 0
+
+        # Lets free pages be given back a few at a time, which only takes
+        # effect on a new database, before WAL mode and the first table
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+            self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        apply_pragmas(self.conn, pragma_profile)
+        if self.write_behind:
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        # Create the tables, or upgrade the ones of an older version
+        migrate(self.conn)
+
+    def _commit(self):
+        """Commit a mutation, or defer it in write-behind mode."""
+        if not self.write_behind:
+            self.flush()
+            return
+        if self._pending_writes == 0:
+            self._first_pending = time.monotonic()
+        self._pending_writes += 1
+        if self._pending_writes >= self.flush_batch:
+            self.flush()
+
+    def flush(self):
+        """Commit every pending write in a single transaction."""
+        self._write_events()
+        self.conn.commit()
+        self._pending_writes = 0
+        self._first_pending = None
+
+    def _write_events(self):
+        if not self._events:
+            return
+        self.conn.executemany(
             """
-            CREATE TABLE IF NOT EXISTS user_xp (
-                chat_id INTEGER,
-                user_id INTEGER,
-                xp INTEGER NOT NULL DEFAULT 0,
-                PRIMARY KEY (chat_id, user_id),
-                FOREIGN KEY (chat_id) REFERENCES chat_settings(chat_id)
-            );
-        """
+            INSERT INTO xp_events (chat_id, sender_id, reciever_id, xp_delta, created_at)
+            VALUES (?, ?, ?, ?, ?);
+            """,
+            self._events,
         )
-        cursor.execute(
-            """
-        CREATE TABLE IF NOT EXISTS username (
-            chat_id INTEGER,
-            user_id INTEGER,
-            full_name TEXT,
-            PRIMARY KEY (chat_id, user_id),
-            FOREIGN KEY (chat_id) REFERENCES chat_settings(chat_id)
-        );
+        self._events = []
+
+    def flush_if_due(self):
+        """Flush pending writes once they reach the durability window."""
+        if (
+            self._pending_writes
+            and time.monotonic() - self._first_pending >= self.flush_interval
+        ):
+            self.flush()
+
+    def checkpoint(self):
+        """Copy the WAL back into the database, without waiting for readers.
+
+        Returns the pages in the WAL and the pages copied.
         """
-        )
+        self.flush()
+        _, wal_pages, copied = self.conn.execute(
+            "PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        return wal_pages, copied
+
+    def optimize(self):
+        """Refresh the query planner statistics that went stale, each
+        table sampling a bounded number of rows."""
+        self.flush()
+        self.conn.execute("PRAGMA analysis_limit=400")
+        self.conn.execute("PRAGMA optimize")
+
+    def incremental_vacuum(self, pages=256):
+        """Give up to `pages` free pages back to the filesystem and return
+        how many are left, always 0 for databases without auto_vacuum."""
+        if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        self.flush()
+        self.conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        return self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def _load_chat_settings(self, chat_id):
+        """Return (xp_enabled, cooldown_seconds), from the cache if possible."""
+        settings = self.get_cached_chat_settings(chat_id)
+        if settings is not None:
+            return settings
+
+        cursor = self.conn.cursor()
         cursor.execute(
             """
-            CREATE TABLE IF NOT EXISTS chat_cooldown (
-                chat_id INTEGER PRIMARY KEY,
-                cooldown_seconds INTEGER NOT NULL DEFAULT 30,
-                FOREIGN KEY (chat_id) REFERENCES chat_settings(chat_id)
-            );
-            """
+            SELECT
+                (SELECT xp_enabled FROM chat_settings WHERE chat_id=?),
+                (SELECT cooldown_seconds FROM chat_cooldown WHERE chat_id=?);
+            """,
+            (chat_id, chat_id),
         )
-        self.conn.commit()
+        enabled, cooldown = cursor.fetchone()
         cursor.close()
+        settings = (bool(enabled), 30 if cooldown is None else cooldown)
+
+        with self._settings_lock:
+            self.settings_misses += 1
+            self._settings[chat_id] = settings
+            if len(self._settings) > self.settings_cache_size:
+                self._settings.popitem(last=False)
+        return settings
+
+    def get_cached_chat_settings(self, chat_id):
+        """Return the cached (xp_enabled, cooldown_seconds) or None, without any SQL."""
+        with self._settings_lock:
+            settings = self._settings.get(chat_id)
+            if settings is not None:
+                self.settings_hits += 1
+                self._settings.move_to_end(chat_id)
+            return settings
+
+    def settings_stats(self):
+        with self._settings_lock:
+            lookups = self.settings_hits + self.settings_misses
+            return {
+                "size": len(self._settings),
+                "hits": self.settings_hits,
+                "misses": self.settings_misses,
+                "hit_rate": self.settings_hits / lookups if lookups else 0.0,
+            }
+
+    def _leaderboard(self, chat_id):
+        """Return the leaderboard of a chat, loading it from SQLite if needed."""
+        leaderboard = self._leaderboards.get(chat_id)
+        if leaderboard is None:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "SELECT user_id, xp FROM user_xp WHERE chat_id=?", (chat_id,)
+            )
+            leaderboard = Leaderboard(cursor.fetchall())
+            cursor.close()
+            self._leaderboards[chat_id] = leaderboard
+        return leaderboard
+
+    def _invalidate_chat_settings(self, chat_id):
+        with self._settings_lock:
+            self._settings.pop(chat_id, None)
 
     def enable_chat(self, chat_id):
         try:
@@ -77,8 +238,9 @@ class XPDatabase:
                 """,
                 (chat_id,),
             )
-            self.conn.commit()
+            self.flush()
             cursor.close()
+            self._invalidate_chat_settings(chat_id)
             return True
         except sqlite3.Error as _:
             return False
@@ -101,30 +263,24 @@ class XPDatabase:
             """,
                 (chat_id,),
             )
-            self.conn.commit()
+            self.flush()
             cursor.close()
+            self._invalidate_chat_settings(chat_id)
             return True
         except sqlite3.Error as _:
             return False
 
     def is_chat_enabled(self, chat_id):
         """Check if XP tracking is enabled for a chat."""
-        cursor = self.conn.cursor()
-        cursor.execute(
-            """
-            SELECT xp_enabled FROM chat_settings
-            WHERE chat_id=?
-        """,
-            (chat_id,),
-        )
-        result = cursor.fetchone()
-        cursor.close()
-        if result is None:
-            return False
-        return bool(result[0])
+        return self._load_chat_settings(chat_id)[0]
 
-    def update_user_xp(self, chat_id, user_id, xp_delta):
-        """Update a user's XP in the database."""
+    def update_user_xp(self, chat_id, user_id, xp_delta, sender_id=None):
+        """Update a user's XP in the database and record the change in the ledger.
+
+        user_xp holds the running totals, while every change is appended to
+        xp_events with its sender and time.
+        """
+        now = time.time()
         cursor = self.conn.cursor()
         cursor.execute(
             """
@@ -134,41 +290,131 @@ class XPDatabase:
         """,
             (chat_id, user_id, xp_delta, xp_delta),
         )
-        self.conn.commit()
+        # Daily rollup for the weekly and monthly leaderboards
+        cursor.execute(
+            """
+            INSERT INTO xp_daily (chat_id, day, user_id, xp)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(chat_id, day, user_id) DO UPDATE SET xp=xp+?;
+        """,
+            (chat_id, day_of(now), user_id, xp_delta, xp_delta),
+        )
+        # Only once the change went through, so a failed one leaves no event
+        self._events.append((chat_id, sender_id, user_id, xp_delta, now))
+        self._commit()
         cursor.close()
+        if chat_id in self._leaderboards:
+            self._leaderboards[chat_id].add(user_id, xp_delta)
+        if chat_id in self._all_time:
+            self._all_time[chat_id].add(user_id, xp_delta)
 
-    def get_user_xp(self, chat_id, user_id):
-        """Get a user's current XP from the database."""
+    def get_xp_events(self, chat_id, user_id=None, limit=50):
+        """Get the latest [(sender_id, reciever_id, xp_delta, created_at)] of a chat."""
+        self._write_events()
+        cursor = self.conn.cursor()
+        if user_id is None:
+            cursor.execute(
+                """
+                SELECT sender_id, reciever_id, xp_delta, created_at FROM xp_events
+                WHERE chat_id=?
+                ORDER BY created_at DESC
+                LIMIT ?
+            """,
+                (chat_id, limit),
+            )
+        else:
+            # One index range per side instead of scanning the chat's events
+            cursor.execute(
+                """
+                SELECT sender_id, reciever_id, xp_delta, created_at FROM (
+                    SELECT * FROM (
+                        SELECT id, sender_id, reciever_id, xp_delta, created_at
+                        FROM xp_events WHERE chat_id=? AND reciever_id=?
+                        ORDER BY created_at DESC LIMIT ?
+                    )
+                    UNION
+                    SELECT * FROM (
+                        SELECT id, sender_id, reciever_id, xp_delta, created_at
+                        FROM xp_events WHERE chat_id=? AND sender_id=?
+                        ORDER BY created_at DESC LIMIT ?
+                    )
+                )
+                ORDER BY created_at DESC
+                LIMIT ?
+            """,
+                (chat_id, user_id, limit, chat_id, user_id, limit, limit),
+            )
+        results = cursor.fetchall()
+        cursor.close()
+        return results
+
+    def compact_xp_events(self, before, limit=5000):
+        """Delete up to `limit` ledger events older than the `before` timestamp.
+
+        Totals live in user_xp, so this only bounds the history kept on
+        disk. Returns the number of deleted events, call again while it
+        equals `limit`.
+        """
+        self._write_events()
         cursor = self.conn.cursor()
+        # Ids grow with time, so the oldest events are found first
         cursor.execute(
             """
-            SELECT xp FROM user_xp
-            WHERE chat_id=? AND user_id=?
-        """,
-            (chat_id, user_id),
+            DELETE FROM xp_events WHERE id IN (
+                SELECT id FROM xp_events WHERE created_at < ? ORDER BY id LIMIT ?
+            );
+            """,
+            (before, limit),
         )
-        result = cursor.fetchone()
+        deleted = cursor.rowcount
+        self.flush()
         cursor.close()
-        if result is None:
-            return 0
-        return result[0]
+        return deleted
+
+    def get_user_xp(self, chat_id, user_id):
+        """Get a user's current XP."""
+        return self._leaderboard(chat_id).get(user_id)
 
     def get_top_users(self, chat_id, limit=10):
         """Get the top users with the highest XP."""
+        return self._leaderboard(chat_id).top(limit)
+
+    def get_window_top_users(self, chat_id, days, limit=10):
+        """Get the top users by XP earned over the last `days` days, today included."""
         cursor = self.conn.cursor()
         cursor.execute(
             """
-            SELECT user_id, xp FROM user_xp
-            WHERE chat_id=?
-            ORDER BY xp DESC
+            SELECT user_id, SUM(xp) AS window_xp FROM xp_daily
+            WHERE chat_id=? AND day>?
+            GROUP BY user_id
+            ORDER BY window_xp DESC
             LIMIT ?
         """,
-            (chat_id, limit),
+            (chat_id, day_of(time.time()) - days, limit),
         )
         results = cursor.fetchall()
         cursor.close()
         return results
 
+    def compact_xp_daily(self, before_day, limit=5000):
+        """Delete up to `limit` daily rollup rows older than `before_day`.
+
+        Returns the number of deleted rows, call again while it equals `limit`.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            DELETE FROM xp_daily WHERE rowid IN (
+                SELECT rowid FROM xp_daily WHERE day < ? ORDER BY day LIMIT ?
+            );
+            """,
+            (before_day, limit),
+        )
+        deleted = cursor.rowcount
+        self.flush()
+        cursor.close()
+        return deleted
+
     def get_bot_added_by(self, chat_id):
         """Returns the user_id of the user who added the bot to a given group chat."""
         c = self.conn.cursor()
@@ -176,18 +422,107 @@ class XPDatabase:
         result = c.fetchone()
         return result[0] if result else None
 
+    def register_group(self, chat_id, added_by=None):
+        """Remember a group the bot is in, and who added the bot when known."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            INSERT INTO groups (chat_id, user_id, added_at) VALUES (?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET
+            user_id=COALESCE(excluded.user_id, user_id);
+            """,
+            (chat_id, added_by, time.time()),
+        )
+        self._commit()
+        cursor.close()
+
+    def remove_group(self, chat_id):
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM groups WHERE chat_id=?", (chat_id,))
+        self._commit()
+        cursor.close()
+
+    def get_groups(self):
+        """Get the ids of every group the bot is in."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT chat_id FROM groups")
+        results = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        return results
+
+    def start_broadcast(self, name, text):
+        """Record a broadcast to every group, unless it was already started."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            INSERT INTO broadcasts (name, text, started_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO NOTHING;
+            """,
+            (name, text, time.time()),
+        )
+        self.flush()
+        cursor.close()
+
+    def get_broadcast(self, name):
+        """Get the (text, finished_at) of a broadcast, None if unknown."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT text, finished_at FROM broadcasts WHERE name=?", (name,))
+        result = cursor.fetchone()
+        cursor.close()
+        return result
+
+    def get_unfinished_broadcasts(self):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT name FROM broadcasts WHERE finished_at IS NULL ORDER BY started_at")
+        results = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        return results
+
+    def get_broadcast_pending(self, name, limit=500):
+        """Get up to `limit` groups a broadcast still has to go to."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            SELECT chat_id FROM groups g WHERE NOT EXISTS (
+                SELECT 1 FROM broadcast_sent s
+                WHERE s.name=? AND s.chat_id=g.chat_id
+            )
+            ORDER BY chat_id
+            LIMIT ?
+            """,
+            (name, limit),
+        )
+        results = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        return results
+
+    def mark_broadcast_sent(self, name, chat_id, ok=True):
+        """Checkpoint a group a broadcast is done with, sent or failed."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "INSERT OR REPLACE INTO broadcast_sent (name, chat_id, ok) VALUES (?, ?, ?)",
+            (name, chat_id, int(ok)),
+        )
+        self._commit()
+        cursor.close()
+
+    def finish_broadcast(self, name):
+        """Mark a broadcast as done and drop its per-group checkpoints."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "UPDATE broadcasts SET finished_at=? WHERE name=?", (time.time(), name))
+        cursor.execute("DELETE FROM broadcast_sent WHERE name=?", (name,))
+        self.flush()
+        cursor.close()
+
     def get_medal(self, chat_id, user_id):
-        top_3_id = self.get_top_users(chat_id)[:3]
-        n = len(top_3_id)
-
-        if n > 0 and user_id in top_3_id[0]:
-            return "🥇"
-        elif n > 1 and user_id in top_3_id[1]:
-            return "🥈"
-        elif n > 2 and user_id in top_3_id[2]:
-            return "🥉"
-        else:
-            return ""
+        return self._leaderboard(chat_id).medal(user_id)
+
+    def get_rank(self, chat_id, user_id):
+        """Get the 0-based position of a user in the chat, None if unranked."""
+        return self._leaderboard(chat_id).rank(user_id)
 
     def remove_user(self, user_id, chat_id):
         c = self.conn.cursor()
@@ -195,20 +530,29 @@ class XPDatabase:
             "DELETE FROM user_xp WHERE chat_id=? AND user_id=?", (
                 chat_id, user_id)
         )
-        self.conn.commit()
+        c.execute(
+            "DELETE FROM xp_daily WHERE chat_id=? AND user_id=?", (
+                chat_id, user_id)
+        )
+        self._commit()
         c.close()
+        if chat_id in self._leaderboards:
+            self._leaderboards[chat_id].remove(user_id)
+        # Their archived XP stays, the chat's totals are rebuilt on next use
+        self._all_time.pop(chat_id, None)
 
     def update_username(self, chat_id, user_id, full_name):
         cursor = self.conn.cursor()
         cursor.execute(
             """
-            INSERT INTO username (chat_id, user_id, full_name)
-            VALUES (?, ?, ?)
-            ON CONFLICT(chat_id, user_id) DO UPDATE SET full_name = excluded.full_name;
+            INSERT INTO username (chat_id, user_id, full_name, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(chat_id, user_id) DO UPDATE SET
+            full_name = excluded.full_name, updated_at = excluded.updated_at;
             """,
-            (chat_id, user_id, full_name),
+            (chat_id, user_id, full_name, time.time()),
         )
-        self.conn.commit()
+        self._commit()
         cursor.close()
 
     def get_stored_username_by_user_id(self, chat_id, user_id):
@@ -226,18 +570,38 @@ class XPDatabase:
         else:
             return None
 
+    def get_stored_usernames(self, chat_id, user_ids):
+        """Get {user_id: (full_name, updated_at)} for the stored users of a chat."""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        cursor = self.conn.cursor()
+        cursor.execute(
+            f"""
+            SELECT user_id, full_name, updated_at FROM username
+            WHERE chat_id=? AND user_id IN ({",".join("?" * len(user_ids))});
+            """,
+            (chat_id, *user_ids),
+        )
+        results = cursor.fetchall()
+        cursor.close()
+        return {
+            user_id: (full_name, updated_at or 0)
+            for user_id, full_name, updated_at in results
+        }
+
     def refresh_username(self, chat_id, user_id, full_name):
         cursor = self.conn.cursor()
         cursor.execute(
             """
-        INSERT INTO username (chat_id, user_id, full_name)
-        VALUES (?, ?, ?)
+        INSERT INTO username (chat_id, user_id, full_name, updated_at)
+        VALUES (?, ?, ?, ?)
         ON CONFLICT(chat_id, user_id) DO UPDATE SET
-        full_name=excluded.full_name;
+        full_name=excluded.full_name, updated_at=excluded.updated_at;
         """,
-            (chat_id, user_id, full_name),
+            (chat_id, user_id, full_name, time.time()),
         )
-        self.conn.commit()
+        self._commit()
         cursor.close()
 
     def set_chat_cooldown(self, chat_id, seconds):
@@ -251,24 +615,213 @@ class XPDatabase:
                 """,
                 (chat_id, seconds),
             )
-            self.conn.commit()
+            self.flush()
+            cursor.close()
+            self._invalidate_chat_settings(chat_id)
+            return True
+        except sqlite3.Error as _:
+            return False
+
+    def set_chat_rate_limit(self, chat_id, changes, seconds):
+        try:
+            cursor = self.conn.cursor()
+            if changes is None:
+                cursor.execute(
+                    "DELETE FROM chat_rate_limit WHERE chat_id = ?", (chat_id,))
+            else:
+                cursor.execute(
+                    """
+                    INSERT INTO chat_rate_limit (chat_id, changes, seconds)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(chat_id) DO UPDATE SET
+                    changes = excluded.changes, seconds = excluded.seconds;
+                    """,
+                    (chat_id, changes, seconds),
+                )
+            self.flush()
             cursor.close()
             return True
         except sqlite3.Error as _:
             return False
 
+    def get_chat_rate_limits(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT chat_id, changes, seconds FROM chat_rate_limit")
+        results = {chat_id: (changes, seconds)
+                   for chat_id, changes, seconds in cursor.fetchall()}
+        cursor.close()
+        return results
+
     def get_chat_cooldown(self, chat_id):
+        return self._load_chat_settings(chat_id)[1]
+
+    def start_new_season(self, season):
+        """Archive the current XP totals as `season` and start again from zero.
+
+        The user_xp table is renamed rather than copied, so the rollover
+        takes the same time whatever the number of users, and it happens in
+        a single transaction on the open connection.
+        """
+        self.flush()
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT 1 FROM seasons WHERE season=?", (season,))
+        if cursor.fetchone() is not None:
+            cursor.close()
+            raise ValueError(f"Season {season} already exists")
+
+        table_name = next_archive_name(cursor)
+        cursor.execute("BEGIN")
+        try:
+            # The index of user_xp is already named after table_name
+            cursor.execute(f"ALTER TABLE user_xp RENAME TO {table_name}")
+            cursor.execute(
+                "INSERT INTO seasons (season, table_name, ended_at) VALUES (?, ?, ?)",
+                (season, table_name, time.time()),
+            )
+            create_user_xp_table(cursor, next_archive_name(cursor))
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        self._leaderboards.clear()
+
+    def _list_archives(self):
+        try:
+            names = os.listdir(self.archive_dir)
+        except OSError:
+            return []
+        own = os.path.basename(self.db_name)
+        # Their XP was imported into a season, it would count twice
+        imported = {file for (file,) in self.conn.execute(
+            "SELECT file FROM imported_archives")}
+        return sorted(
+            os.path.join(self.archive_dir, name) for name in names
+            if ARCHIVE_FILE.match(name) and name != own and name not in imported
+        )
+
+    def _attach(self, path):
+        """Attach an archive read-only, at most MAX_ATTACHED at a time."""
+        alias = self._attached.get(path)
+        if alias is not None:
+            self._attached.move_to_end(path)
+            return alias
+        # ATTACH and DETACH can't run inside a transaction
+        self.flush()
+        if len(self._attached) >= MAX_ATTACHED:
+            _, oldest = self._attached.popitem(last=False)
+            self.conn.execute(f"DETACH DATABASE {oldest}")
+        self._attach_count += 1
+        alias = f"archive_{self._attach_count}"
+        uri = "file:" + os.path.abspath(path).replace("?", "%3f") + "?mode=ro"
+        self.conn.execute("ATTACH DATABASE ? AS " + alias, (uri,))
+        self._attached[path] = alias
+        return alias
+
+    def _all_time_leaderboard(self, chat_id):
+        """Return the XP of a chat summed over every season and archive."""
+        archives = self._list_archives()
+        if archives != self._archive_files:
+            # A new yearly file showed up, every total may have changed
+            self._archive_files = archives
+            self._all_time.clear()
+
+        leaderboard = self._all_time.get(chat_id)
+        if leaderboard is not None:
+            return leaderboard
+
         cursor = self.conn.cursor()
+        cursor.execute("SELECT table_name FROM seasons")
+        tables = ["user_xp", *(row[0] for row in cursor.fetchall())]
+        union = " UNION ALL ".join(
+            f"SELECT user_id, xp FROM {table} WHERE chat_id=?" for table in tables
+        )
         cursor.execute(
-            """
-            SELECT cooldown_seconds FROM chat_cooldown
-            WHERE chat_id = ?;
-            """,
-            (chat_id,),
+            f"SELECT user_id, SUM(xp) FROM ({union}) GROUP BY user_id",
+            (chat_id,) * len(tables),
         )
+        totals = dict(cursor.fetchall())
+
+        for path in archives:
+            try:
+                alias = self._attach(path)
+                cursor.execute(
+                    f"SELECT user_id, SUM(xp) FROM {alias}.user_xp "
+                    "WHERE chat_id=? GROUP BY user_id",
+                    (chat_id,),
+                )
+            except sqlite3.Error as e:
+                logger.warning(f"Skipping archive {path}: {e}")
+                continue
+            for user_id, xp in cursor.fetchall():
+                totals[user_id] = totals.get(user_id, 0) + xp
+        cursor.close()
+
+        # Still right after a rollover, the season moves but its XP stays
+        leaderboard = Leaderboard(totals.items())
+        self._all_time[chat_id] = leaderboard
+        return leaderboard
+
+    def get_all_time_top_users(self, chat_id, limit=10):
+        """Get the top users by XP over every season, archives included."""
+        return self._all_time_leaderboard(chat_id).top(limit)
+
+    def get_all_time_user_xp(self, chat_id, user_id):
+        """Get a user's XP over every season, archives included."""
+        return self._all_time_leaderboard(chat_id).get(user_id)
+
+    def get_seasons(self):
+        """Get the [(season, ended_at)] of the archived seasons, oldest first."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT season, ended_at FROM seasons ORDER BY ended_at")
+        results = cursor.fetchall()
+        cursor.close()
+        return results
+
+    def _season_table(self, season):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT table_name FROM seasons WHERE season=?", (season,))
         result = cursor.fetchone()
         cursor.close()
-        if result is not None:
-            return result[0]
-        else:
-            return 30
+        if result is None:
+            raise ValueError(f"Unknown season {season}")
+        return result[0]
+
+    def get_season_top_users(self, season, chat_id, limit=10):
+        """Get the top users of an archived season."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            f"""
+            SELECT user_id, xp FROM {self._season_table(season)}
+            WHERE chat_id=?
+            ORDER BY xp DESC
+            LIMIT ?
+        """,
+            (chat_id, limit),
+        )
+        results = cursor.fetchall()
+        cursor.close()
+        return results
+
+    def get_season_user_xp(self, season, chat_id, user_id):
+        """Get a user's XP at the end of an archived season."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            f"""
+            SELECT xp FROM {self._season_table(season)}
+            WHERE chat_id=? AND user_id=?
+        """,
+            (chat_id, user_id),
+        )
+        result = cursor.fetchone()
+        cursor.close()
+        if result is None:
+            return 0
+        return result[0]
+
+    def close(self):
+        """Flush pending writes and close the underlying connection."""
+        self.flush()
+        self.conn.close()
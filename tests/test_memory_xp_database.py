@@ -0,0 +1,123 @@
+import os
+import tempfile
+import unittest
+
+from database_queries import MemoryXPDatabase
+
+
+class JournalReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "xp_data.snapshot")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def crash(self, db):
+        """Drop an engine without closing it, like a killed process."""
+        db._journal.flush()
+        db._journal.close()
+
+    def fill(self, db):
+        db.enable_chat(-1)
+        db.set_chat_cooldown(-1, 10)
+        db.set_chat_rate_limit(-1, 3, 30)
+        db.update_user_xp(-1, 10, 2, sender_id=11)
+        db.update_user_xp(-1, 11, -1, sender_id=10)
+        db.update_username(-1, 10, "Alice")
+        db.register_group(-1, added_by=10)
+
+    def assertFilled(self, db):
+        self.assertTrue(db.is_chat_enabled(-1))
+        self.assertEqual(db.get_chat_cooldown(-1), 10)
+        self.assertEqual(db.get_chat_rate_limits(), {-1: (3, 30)})
+        self.assertEqual(db.get_top_users(-1), [(10, 2), (11, -1)])
+        self.assertEqual(len(db.get_xp_events(-1)), 2)
+        self.assertEqual(db.get_stored_username_by_user_id(-1, 10), "Alice")
+        self.assertEqual(db.get_groups(), [-1])
+
+    def test_journal_is_replayed_without_snapshot(self):
+        db = MemoryXPDatabase(self.path)
+        self.fill(db)
+        self.crash(db)
+
+        db = MemoryXPDatabase(self.path)
+        try:
+            self.assertFilled(db)
+        finally:
+            db.close()
+
+    def test_journal_is_replayed_after_snapshot(self):
+        db = MemoryXPDatabase(self.path)
+        self.fill(db)
+        db.checkpoint()
+        db.update_user_xp(-1, 10, 5, sender_id=11)
+        db.start_new_season("2024")
+        self.crash(db)
+
+        db = MemoryXPDatabase(self.path)
+        try:
+            # The rollover is replayed on top of the snapshot
+            self.assertEqual(db.get_user_xp(-1, 10), 0)
+            self.assertEqual(db.get_season_user_xp("2024", -1, 10), 7)
+            self.assertEqual(db.get_all_time_user_xp(-1, 10), 7)
+            self.assertEqual(len(db.get_xp_events(-1)), 3)
+        finally:
+            db.close()
+
+    def test_crash_between_snapshot_and_truncation(self):
+        db = MemoryXPDatabase(self.path)
+        self.fill(db)
+        with open(f"{self.path}.journal", encoding="utf-8") as journal:
+            folded = journal.read()
+        db.checkpoint()
+        db.update_user_xp(-1, 10, 5, sender_id=11)
+        self.crash(db)
+        # The journal was not emptied yet when the snapshot was written
+        with open(f"{self.path}.journal", encoding="utf-8") as journal:
+            after = journal.read()
+        with open(f"{self.path}.journal", "w", encoding="utf-8") as journal:
+            journal.write(folded + after)
+
+        db = MemoryXPDatabase(self.path)
+        try:
+            self.assertEqual(db.get_user_xp(-1, 10), 7)
+            self.assertEqual(len(db.get_xp_events(-1)), 3)
+        finally:
+            db.close()
+
+    def test_torn_last_line_is_ignored(self):
+        db = MemoryXPDatabase(self.path)
+        self.fill(db)
+        self.crash(db)
+        with open(f"{self.path}.journal", "a", encoding="utf-8") as journal:
+            journal.write('[99, "update_user_xp", -1, 1')
+
+        db = MemoryXPDatabase(self.path)
+        try:
+            self.assertFilled(db)
+            # And the engine carries on from there
+            db.update_user_xp(-1, 10, 1, sender_id=11)
+        finally:
+            db.close()
+
+        db = MemoryXPDatabase(self.path)
+        try:
+            self.assertEqual(db.get_user_xp(-1, 10), 3)
+        finally:
+            db.close()
+
+    def test_close_keeps_everything(self):
+        db = MemoryXPDatabase(self.path, write_behind=True)
+        self.fill(db)
+        db.close()
+
+        db = MemoryXPDatabase(self.path)
+        try:
+            self.assertFilled(db)
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
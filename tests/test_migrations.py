@@ -0,0 +1,106 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from database_queries import XPDatabase
+from database_queries.migrations import SCHEMA_VERSION
+
+
+def create_unversioned_database(path):
+    """Database as written by the bot before the schema was versioned."""
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE chat_settings (
+            chat_id INTEGER PRIMARY KEY,
+            xp_enabled INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE user_xp (
+            chat_id INTEGER,
+            user_id INTEGER,
+            xp INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id),
+            FOREIGN KEY (chat_id) REFERENCES chat_settings(chat_id)
+        );
+        CREATE TABLE username (
+            chat_id INTEGER,
+            user_id INTEGER,
+            full_name TEXT,
+            PRIMARY KEY (chat_id, user_id),
+            FOREIGN KEY (chat_id) REFERENCES chat_settings(chat_id)
+        );
+        CREATE TABLE chat_cooldown (
+            chat_id INTEGER PRIMARY KEY,
+            cooldown_seconds INTEGER NOT NULL DEFAULT 30,
+            FOREIGN KEY (chat_id) REFERENCES chat_settings(chat_id)
+        );
+        INSERT INTO chat_settings VALUES (-1, 1), (-2, 0);
+        INSERT INTO chat_cooldown VALUES (-1, 45);
+        INSERT INTO user_xp VALUES (-1, 10, 7), (-1, 11, 3), (-1, 12, -2);
+        INSERT INTO username VALUES (-1, 10, 'Alice');
+        """
+    )
+    conn.commit()
+    conn.close()
+
+
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "xp_data.db")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_unversioned_database_is_upgraded(self):
+        create_unversioned_database(self.path)
+
+        db = XPDatabase(self.path)
+        try:
+            version = db.conn.execute("PRAGMA user_version").fetchone()[0]
+            self.assertEqual(version, SCHEMA_VERSION)
+
+            # Existing data is kept
+            self.assertTrue(db.is_chat_enabled(-1))
+            self.assertFalse(db.is_chat_enabled(-2))
+            self.assertEqual(db.get_chat_cooldown(-1), 45)
+            self.assertEqual(db.get_top_users(-1), [(10, 7), (11, 3), (12, -2)])
+            self.assertEqual(db.get_stored_username_by_user_id(-1, 10), "Alice")
+
+            # And the tables of every migration can be used
+            db.update_user_xp(-1, 11, 5, sender_id=10)
+            self.assertEqual(db.get_rank(-1, 11), 0)
+            self.assertEqual(len(db.get_xp_events(-1)), 1)
+            db.register_group(-1, added_by=10)
+            self.assertEqual(db.get_groups(), [-1])
+            self.assertTrue(db.set_chat_rate_limit(-1, 3, 30))
+            self.assertEqual(db.get_chat_rate_limits(), {-1: (3, 30)})
+            db.start_new_season("2024")
+            self.assertEqual(db.get_season_user_xp("2024", -1, 11), 8)
+            self.assertEqual(db.get_all_time_user_xp(-1, 10), 7)
+        finally:
+            db.close()
+
+    def test_upgrade_is_idempotent(self):
+        create_unversioned_database(self.path)
+        XPDatabase(self.path).close()
+
+        db = XPDatabase(self.path)
+        try:
+            self.assertEqual(db.get_user_xp(-1, 10), 7)
+        finally:
+            db.close()
+
+    def test_newer_database_is_refused(self):
+        create_unversioned_database(self.path)
+        conn = sqlite3.connect(self.path)
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION + 1}")
+        conn.close()
+
+        with self.assertRaises(RuntimeError):
+            XPDatabase(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()